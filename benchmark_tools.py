@@ -0,0 +1,262 @@
+# tools for timing the hot paths of the embedding pipeline on synthetic corpora (no spaCy model needed)
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import collections
+import numpy as np
+import pandas as pd
+import matrix_tools
+import vocabulary_tools
+import evaluation_tools
+from parse_tools import CachedDoc
+
+DEPENDENCIES = ['nsubj', 'dobj', 'amod', 'det', 'advmod', 'prep', 'pobj', 'conj', 'cc', 'compound']
+
+def benchmark_contexts(docs, vocabulary, repeat=3):
+    '''
+    benchmark_contexts: time the per-token deptree_* functions against the array-based dependency_contexts on a fixed parsed sample
+    Inputs:
+    - docs: a list of parsed sentences (SpaCy Docs or parse_tools.CachedDocs)
+    - vocabulary: the vocabulary
+    - repeat: number of timed repetitions, the best one is reported
+    Outputs:
+    - a dictionary mapping every context method to its best token-wise and array-based times in seconds and their ratio
+    Raises an AssertionError if the two implementations disagree on any token.
+    '''
+    arrays = [matrix_tools.sentence_arrays(parsed, vocabulary, noun_chunks=True) for parsed in docs]
+    results = {}
+    for name, method in matrix_tools.CONTEXT_METHODS.items():
+        expected = [[method(vocabulary, token) for token in parsed] for parsed in docs]
+        computed = [matrix_tools.dependency_contexts(*sentence, methods=[name])[name] for sentence in arrays]
+        assert expected == computed, name + ': array-based contexts differ from the token-wise ones'
+        tokenwise = _best_time(lambda: [[method(vocabulary, token) for token in parsed] for parsed in docs], repeat)
+        noun_chunks = name == 'deptree_noun_chunks'
+        arraywise = _best_time(lambda: [matrix_tools.dependency_contexts(*matrix_tools.sentence_arrays(parsed, vocabulary, noun_chunks),
+                                                                          methods=[name]) for parsed in docs], repeat)
+        results[name] = {'tokenwise': tokenwise, 'arraywise': arraywise, 'speedup': tokenwise / arraywise}
+    return results
+
+def _best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def synthetic_doc(lemmas, tree_depth=4, seed=0):
+    '''
+    synthetic_doc: a fake parsed sentence over the given lemmas, with a random dependency tree of bounded depth and random noun chunks
+    Inputs:
+    - lemmas: the lemmas (also used as texts) of the tokens
+    - tree_depth: maximum depth of the dependency tree (the root has depth 0)
+    - seed: seed of the tree, labels and chunks
+    Outputs:
+    - a parse_tools.CachedDoc
+    '''
+    rng = np.random.default_rng(seed)
+    length = len(lemmas)
+    heads = np.zeros(length, dtype=np.int64)
+    deps = [str(label) for label in rng.choice(DEPENDENCIES, length)]
+    depths = np.zeros(length, dtype=np.int64)
+    root = int(rng.integers(length)) if length else 0
+    attached = [root]
+    for token in rng.permutation(length):
+        if token == root: continue
+        candidates = [word for word in attached if depths[word] < tree_depth]
+        head = candidates[rng.integers(len(candidates))]
+        heads[token], depths[token] = head, depths[head] + 1
+        if deps[head] == 'prep': deps[token] = 'pobj'
+        attached.append(token)
+    if length:
+        heads[root] = root
+        deps[root] = 'ROOT'
+    chunks = []
+    start = 0
+    while start < length:
+        end = min(length, start + int(rng.integers(1, 4)))
+        if rng.random() < 0.3: # the chunk root is its first token attached outside the chunk
+            outside = [token for token in range(start, end) if not start <= heads[token] < end or heads[token] == token]
+            if outside: chunks.append((start, end, outside[0]))
+        start = end
+    return CachedDoc(list(lemmas), list(lemmas), ['NOUN'] * length, deps, heads, chunks)
+
+def synthetic_corpus(n_sentences=1000, vocabulary_size=1000, sentence_length=15, tree_depth=4, seed=0):
+    '''
+    synthetic_corpus: fake parsed sentences with Zipf-distributed lemmas 'w0', 'w1', ... and their vocabulary
+    Inputs:
+    - n_sentences: number of sentences
+    - vocabulary_size: number of distinct lemmas
+    - sentence_length: mean sentence length (Poisson distributed, at least 4)
+    - tree_depth: maximum dependency tree depth
+    - seed: seed of the generator
+    Outputs:
+    - docs: a list of parse_tools.CachedDoc
+    - vocabulary: an OrderedDict mapping every lemma to [TF, TDF, ID], in the format of vocabularize after indexize
+    '''
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, vocabulary_size + 1)
+    probabilities = 1. / ranks / np.sum(1. / ranks)
+    docs = []
+    for ii in range(n_sentences):
+        length = max(4, int(rng.poisson(sentence_length)))
+        lemmas = ['w%d' % word for word in rng.choice(vocabulary_size, length, p=probabilities)]
+        docs.append(synthetic_doc(lemmas, tree_depth, seed=seed * 1000003 + ii))
+    frequencies = collections.Counter(lemma for parsed in docs for lemma in parsed.lemmas)
+    vocabulary = collections.OrderedDict(('w%d' % word, np.array([frequencies['w%d' % word], 1, 0], dtype='int'))
+                                         for word in range(vocabulary_size))
+    return docs, vocabulary_tools.indexize(vocabulary)
+
+class SyntheticNLP:
+    '''
+    A stand-in for a spaCy model: every text is split on whitespace and given a synthetic dependency tree seeded by its content.
+    Supports the pipe, pipe_names, select_pipes and meta attributes used by vocabularize, pipeline_tools and parse_tools.
+    '''
+    pipe_names = []
+    meta = {'lang': 'xx', 'name': 'synthetic', 'version': '0'}
+
+    def __init__(self, tree_depth=4):
+        self.tree_depth = tree_depth
+
+    def __call__(self, text):
+        return synthetic_doc(text.split(), self.tree_depth, seed=zlib.crc32(text.encode('utf-8')))
+
+    def pipe(self, texts, batch_size=1000):
+        for text in texts: yield self(text)
+
+    def select_pipes(self, disable=()):
+        return contextlib.nullcontext()
+
+def write_corpus(directory, docs, sentences_per_file=100):
+    # write_corpus: store synthetic sentences as sample files (sentences separated by full stops), returning their paths
+    paths = []
+    for start in range(0, len(docs), sentences_per_file):
+        paths.append(os.path.join(directory, 'sample_%06d.txt' % (start // sentences_per_file)))
+        with open(paths[-1], 'w') as f:
+            for parsed in docs[start:start+sentences_per_file]: f.write(' '.join(parsed.lemmas) + '.\n')
+    return paths
+
+def measure(function, repeat=1, memory=True):
+    '''
+    measure: run a function and report its best wall time over repeat runs and, in a separate traced run, its peak traced memory
+    Outputs:
+    - the result of the last run, the best time in seconds and the peak memory in bytes (None if memory is False)
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory: # traced separately, since tracing slows Python code down
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, best, peak
+
+def run_benchmarks(sizes=(1000, 2000, 4000), n_sentences=2000, sentence_length=15, tree_depth=4, repeat=1, memory=True, seed=0):
+    '''
+    run_benchmarks: time every hot path on synthetic corpora of growing vocabulary size
+    Inputs:
+    - sizes: the vocabulary sizes to benchmark
+    - n_sentences, sentence_length, tree_depth: the shape of the synthetic corpus (see synthetic_corpus)
+    - repeat: timed runs per benchmark, the best one is reported
+    - memory: whether to also measure the peak traced memory of every benchmark
+    - seed: seed of the synthetic corpora
+    Outputs:
+    - a list of records {'benchmark', 'size', 'seconds', 'tokens_per_s', 'pairs_per_s', 'items_per_s', 'peak_mb'} (unused rates are None)
+    '''
+    results = []
+    def record(benchmark, size, function, tokens=None, pairs=None, items=None):
+        result, seconds, peak = measure(function, repeat, memory)
+        if callable(pairs): pairs = pairs(result)
+        rate = lambda amount: None if amount is None else amount / seconds
+        results.append({'benchmark': benchmark, 'size': size, 'seconds': seconds, 'tokens_per_s': rate(tokens),
+                        'pairs_per_s': rate(pairs), 'items_per_s': rate(items),
+                        'peak_mb': None if peak is None else peak / 2. ** 20})
+        return result
+
+    for size in sizes:
+        docs, vocabulary = synthetic_corpus(n_sentences, size, sentence_length, tree_depth, seed)
+        tokens = sum(len(parsed) for parsed in docs)
+        def naive():
+            buffer = matrix_tools.PairBuffer(np.zeros((size, size), dtype=np.uint16))
+            for parsed in docs: matrix_tools.naive_update(buffer, vocabulary, parsed)
+            return buffer.flush()
+        counts = record('naive_update', size, naive, tokens=tokens, pairs=lambda matrix: int(matrix.sum(dtype=np.int64)))
+        for name, method in matrix_tools.CONTEXT_METHODS.items():
+            def syntactic():
+                buffer = matrix_tools.PairBuffer(np.zeros((size, size), dtype=np.uint16))
+                for parsed in docs: matrix_tools.syntactic_update(buffer, vocabulary, parsed, method)
+                return buffer.flush()
+            record('syntactic_update:' + name, size, syntactic, tokens=tokens, pairs=lambda matrix: int(matrix.sum(dtype=np.int64)))
+        similarities = record('construct_similarities', size, lambda: matrix_tools.construct_similarities(counts, dtype=np.float32),
+                              pairs=size * size)
+
+        directory = tempfile.mkdtemp()
+        try:
+            paths = write_corpus(directory, docs)
+            record('vocabularize', size, lambda: vocabulary_tools.vocabularize(paths, SyntheticNLP(tree_depth), progress=False), tokens=tokens)
+        finally: shutil.rmtree(directory)
+
+        keyed = collections.OrderedDict(('%s | NOUN' % key, value.copy()) for key, value in vocabulary.items())
+        compact = vocabulary_tools.Vocabulary.from_dict(keyed)
+        threshold = np.median(compact.counts[:, 0])
+        # delete=False keeps the vocabularies intact between runs
+        record('cut_frequency:dict', size, lambda: vocabulary_tools.cut_frequency(keyed, threshold, delete=False, verbose=False), items=size)
+        record('cut_frequency:Vocabulary', size,
+               lambda: vocabulary_tools.cut_frequency(compact, threshold, delete=False, verbose=False), items=size)
+
+        rng = np.random.default_rng(seed)
+        tests = pd.DataFrame(rng.choice(list(vocabulary), (1000, 5)), columns=['original', 'ground_truth', 'test_1', 'test_2', 'test_3'])
+        record('multifold_test', size, lambda: evaluation_tools.multifold_test(tests, similarities, vocabulary), items=len(tests))
+    return results
+
+def compare_results(baseline, current):
+    '''
+    compare_results: the time ratio (current / baseline) of every benchmark and size present in two result lists (or JSON files)
+    '''
+    if isinstance(baseline, str):
+        with open(baseline) as f: baseline = json.load(f)['results']
+    if isinstance(current, str):
+        with open(current) as f: current = json.load(f)['results']
+    times = {(entry['benchmark'], entry['size']): entry['seconds'] for entry in baseline}
+    ratios = {}
+    for entry in current:
+        key = (entry['benchmark'], entry['size'])
+        if key in times: ratios['%s@%d' % key] = entry['seconds'] / times[key]
+    return ratios
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the embedding pipeline on synthetic corpora.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help='vocabulary sizes')
+    parser.add_argument('--sentences', type=int, default=2000, help='number of synthetic sentences')
+    parser.add_argument('--sentence-length', type=int, default=15, help='mean sentence length')
+    parser.add_argument('--tree-depth', type=int, default=4, help='maximum dependency tree depth')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurements')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='a previous JSON results file to compare against')
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.sizes, args.sentences, args.sentence_length, args.tree_depth, args.repeat, not args.no_memory)
+    with open(args.output, 'w') as f:
+        json.dump({'python': sys.version, 'platform': platform.platform(), 'numpy': np.__version__, 'arguments': vars(args),
+                   'results': results}, f, indent=1)
+    for entry in results:
+        rates = ', '.join('%s %.0f' % (name, entry[name]) for name in ('tokens_per_s', 'pairs_per_s', 'items_per_s') if entry[name])
+        memory = '' if entry['peak_mb'] is None else ', peak %.1f MB' % entry['peak_mb']
+        print('%-45s V=%-6d %8.3fs  %s%s' % (entry['benchmark'], entry['size'], entry['seconds'], rates, memory))
+    if args.compare:
+        for name, ratio in compare_results(args.compare, results).items(): print('%-52s x%.2f' % (name, ratio))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,8 @@
 import pandas as pd
 import csv 
-import copy
-from matrix_tools import pair_similarity
 import numpy as np
-from tqdm import tqdm_notebook
+from profiling_tools import PROFILER
+from quantization_tools import QuantizedSimilarities
 
 '''
 A variety of format-specific tools that we use to perform the evaluation of our models.
@@ -27,46 +26,53 @@ def reduce_toefl(tests, minimum, vocabulary):
     '''
     reduce_toefl: given a TOEFL DataFrame, a vocabulary and a minimum occurrence constraint, remove invalid entries
     '''
-    reduced = copy.deepcopy(tests)
-    to_delete = []
-    for ii in range(len(tests)):
-        badword = False
-        test = tests.iloc[ii]
-        for jj in range(0,5):
-            if vocabulary[test[jj]][0] < minimum:
-                badword = True
-                break
-        if badword: to_delete.append(ii)
-    reduced = reduced.drop(reduced.index[to_delete])
-    return reduced
-        
+    frequencies = vocabulary_lookup(vocabulary, tests.iloc[:, :5].values.ravel(), position=0).reshape(-1, 5)
+    return tests[(frequencies >= minimum).all(axis=1)]
+
+def toefl_ids(tests, vocabulary):
+    '''
+    toefl_ids: convert a TOEFL DataFrame into an int array of shape (N, 5) holding the vocabulary IDs of its (original, ground_truth, test_1, test_2, test_3) words
+    '''
+    return vocabulary_lookup(vocabulary, tests.iloc[:, :5].values.ravel(), position=2).reshape(-1, 5)
+
+def vocabulary_lookup(vocabulary, keys, position=2):
+    '''
+    vocabulary_lookup: gather the given position (0 for TF, 1 for TDF, 2 for ID) of a list of keys into an int array; raises KeyError for unknown keys
+    '''
+    if hasattr(vocabulary, 'rows'):
+        rows = vocabulary.rows(keys)
+        if (rows < 0).any(): raise KeyError(keys[np.flatnonzero(rows < 0)[0]])
+        return vocabulary.counts[rows, position]
+    return np.array([vocabulary[key][position] for key in keys], dtype=np.int64)
+
 def multifold_test(tests, similarities, vocabulary, split=10):
     '''
     multifold_tests: given a TOEFL DataFrame, a similarities matrix and a vocabulary, split into a number of mutually exclusive tests for variance control, perform the evaluations and return results
+    The similarities can be a precomputed matrix (in memory or memory-mapped), a matrix_tools.CosineSimilarities computing them on demand
+    or a matrix_tools.SimilarityCache shared between evaluations;
+    they are gathered for all tests at once and a test is answered correctly if the ground truth is (the first of) the most similar candidates.
     '''
+    PROFILER.count('toefl_tests', len(tests))
+    with PROFILER.stage('evaluation:multifold_test'):
+        ids = toefl_ids(tests, vocabulary)
+        sims = np.asarray(similarities[ids[:, :1], ids[:, 1:]], dtype=np.float64)
+    sims[np.isnan(sims)] = -np.inf # undefined similarities are never preferred
+    errors = np.argmax(sims, axis=1) != 0
+    folds = (np.arange(len(tests)) / (len(tests) / split)).astype(int)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(folds)) + 1])
+    ends = np.concatenate([starts[1:], [len(tests)]])
     results = np.zeros([split])
-    current_index = 0
     batch_sizes = []
     num_errorss = []
-    batch_size = 0
-    num_errors = 0.0
-    for ii in range(len(tests)):
-        if current_index != int(ii/(len(tests)/split)):
-            results[current_index] = (batch_size - num_errors)/batch_size
-            batch_sizes.append(batch_size)
-            num_errorss.append(num_errors)
-            current_index = int(ii/(len(tests)/split))
-            batch_size = 0
-            num_errors = 0.0
-        test = tests.iloc[ii]
-        original = vocabulary[test[0]][2]
-        sims = np.zeros([4])
-        for jj in range(0,4):
-               sims[jj] = similarities[original, vocabulary[test[jj+1]][2]]
-        indices = np.argsort(sims * -1)
-        if indices[0] != 0: num_errors +=1
-        batch_size += 1
-    results[split-1] = (batch_size-num_errors)/batch_size
+    for start, end in zip(starts, ends):
+        batch_size = int(end - start)
+        num_errors = float(errors[start:end].sum())
+        if end == len(tests): # the last fold is reported in the last position and not added to the lists
+            results[split-1] = (batch_size-num_errors)/batch_size
+            break
+        results[folds[start]] = (batch_size - num_errors)/batch_size
+        batch_sizes.append(batch_size)
+        num_errorss.append(num_errors)
     return results, batch_sizes, num_errorss
     
 def construct_bless(pathfile, vocabulary, similarities):
@@ -85,74 +91,81 @@ def construct_bless(pathfile, vocabulary, similarities):
             data.append(newrow)
     bless = pd.DataFrame(data=data, columns=['root','category','word', 'score'])
     bless = reduce_bless(bless, vocabulary)
-    bless['score'] = bless['score'].astype(float)
-    for ii in tqdm_notebook(range(len(bless))):
-        bless.set_value(ii, 'score', pair_similarity(bless.iloc[ii]['root'], bless.iloc[ii]['word'], vocabulary, similarities))
+    bless['score'] = bless_scores(bless, vocabulary, similarities)
     return bless
 
+def bless_scores(bless, vocabulary, similarities):
+    '''
+    bless_scores: given a BLESS DataFrame, a vocabulary and a similarities matrix (or matrix_tools.CosineSimilarities or SimilarityCache), gather the similarities of all root-word pairs at once
+    '''
+    PROFILER.count('bless_pairs', len(bless))
+    with PROFILER.stage('evaluation:bless_scores'):
+        roots = vocabulary_lookup(vocabulary, bless['root'].values, position=2)
+        words = vocabulary_lookup(vocabulary, bless['word'].values, position=2)
+        return np.asarray(similarities[roots, words], dtype=float)
+
 def reduce_bless(bless, vocabulary, minimum=40):
     '''
     reduce_bless: given a BLESS test DataFrame and a vocabulary, remove root words that occurr less than the minimum allowed number of times and comparison tokens that are OOV
     '''
-    to_delete = []
-    for ii in range(len(bless)):
-        if bless.iloc[ii]['root'] not in vocabulary.keys() or vocabulary[bless.iloc[ii]['root']][0]< minimum or bless.iloc[ii]['word'] not in vocabulary.keys(): to_delete.append(ii)
-    bless = bless.drop(bless.index[to_delete])
+    keep = np.array([root in vocabulary and word in vocabulary for root, word in zip(bless['root'], bless['word'])], dtype=bool)
+    bless = bless[keep]
+    bless = bless[vocabulary_lookup(vocabulary, bless['root'].values, position=0) >= minimum]
     bless.index = [i for i in range(len(bless))]
     return bless
 
+BLESS_CATEGORIES = ['attri', 'coord', 'event', 'mero', 'hyper', 'random-j', 'random-v', 'random-n']
+
 def summarize(bless):
     '''
     summarize: given a BLESS DataFrame, return a dictionary that maps root words to centered and mean vectors
+    The vectors hold the maximum score of every category of BLESS_CATEGORIES; a ValueError is raised if a root has no word in some category.
     '''
-    words = {}
-    attributes = []
-    coords = []
-    events = []
-    hypers = []
-    meros = []
-    randomjs = []
-    randomvs = []
-    randomns = []
-    currentword = bless.iloc[0]['root']
-    for ii in range(len(bless)):
-        if currentword != bless.iloc[ii]['root']: 
-            words[currentword] = [attributes, coords, events, meros, hypers, randomjs, randomvs, randomns]
-            attributes = []
-            coords = []
-            events = []
-            hypers = []
-            meros = []
-            randomjs = []
-            randomvs = []
-            randomns = []
-            currentword = bless.iloc[ii]['root']
-        if bless.iloc[ii]['category'] == 'mero': meros.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'hyper': hypers.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'attri': attributes.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'coord': coords.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'event': events.append(bless.iloc[ii]['score'])  
-        if bless.iloc[ii]['category'] == 'random-j': randomjs.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'random-v': randomvs.append(bless.iloc[ii]['score'])
-        if bless.iloc[ii]['category'] == 'random-n': randomns.append(bless.iloc[ii]['score'])
-    words[currentword] = [attributes, coords, events, meros, hypers, randomjs, randomvs, randomns]
-    
-    for word in words:
-        vector = []
-        for ii in range(len(words[word])):
-            newvalue = max(words[word][ii])
-            vector.append(newvalue)
-        words[word] = vector
-    
-    for ii, word in enumerate(words):
-        vector = center_and_mean(words[word])
-        words[word] = vector
-        
-    return words
+    with PROFILER.stage('evaluation:summarize'):
+        maxima = bless.groupby(['root', 'category'], sort=False)['score'].max().unstack('category')
+        maxima = maxima.reindex(index=pd.unique(bless['root']), columns=BLESS_CATEGORIES)
+        incomplete = maxima.isna().any(axis=1)
+        if incomplete.any(): raise ValueError('BLESS roots without a word in every category: ' + ', '.join(map(str, maxima.index[incomplete])))
+        vectors = center_and_mean(maxima.values.astype(float))
+    return {word: vector for word, vector in zip(maxima.index, vectors)}
             
 def center_and_mean(vector):
     '''
-    center_and_mean: given a vector, return its zero-mean, unit-norm equivallent
+    center_and_mean: given a vector (or a matrix of row vectors), return its zero-mean, unit-norm equivallent
+    '''
+    vector = np.asarray(vector, dtype=float)
+    vector = vector - np.mean(vector, axis=-1, keepdims=True)
+    return vector/ np.std(vector, ddof=1, axis=-1, keepdims=True)
+
+def quantization_report(similarities, vocabulary, toefl=None, bless=None, dtypes=(np.int8, np.float16), tolerance=0.01, split=10):
+    '''
+    quantization_report: measure the storage saving and the evaluation impact of quantizing a similarities matrix
+    Inputs:
+    - similarities: the reference similarities, as accepted by quantization_tools.QuantizedSimilarities
+    - vocabulary: the vocabulary
+    - toefl: a reduced TOEFL DataFrame (see reduce_toefl), optional
+    - bless: a reduced BLESS DataFrame (see construct_bless), optional
+    - dtypes: the quantization types to evaluate
+    - tolerance: the largest acceptable change of the mean multifold_test accuracy
+    - split: number of TOEFL folds, as in multifold_test
+    Outputs:
+    - a list of dictionaries, one per dtype, with the dtype, the stored bytes and the compression relative to the reference matrix,
+      the mean TOEFL accuracy and its change (toefl_accuracy, toefl_delta), the largest absolute change of a BLESS score (bless_max_error)
+      and whether the TOEFL change is within tolerance
+    int8 rounds similarities that differ by less than the row scale to the same code; multifold_test answers such ties with the ground
+    truth, so sparse counts with many near-zero similarities can show a spurious TOEFL gain.
     '''
-    vector = vector - np.mean(vector)
-    return vector/ np.std(vector, ddof=1)
+    reference_bytes = similarities.shape[0] * similarities.shape[1] * np.dtype(similarities.dtype).itemsize
+    if toefl is not None: reference_accuracy = multifold_test(toefl, similarities, vocabulary, split)[0].mean()
+    if bless is not None: reference_scores = bless_scores(bless, vocabulary, similarities)
+    report = []
+    for dtype in dtypes:
+        quantized = QuantizedSimilarities(similarities, dtype)
+        entry = {'dtype': np.dtype(dtype).name, 'nbytes': quantized.nbytes, 'compression': reference_bytes / float(quantized.nbytes)}
+        if toefl is not None:
+            entry['toefl_accuracy'] = multifold_test(toefl, quantized, vocabulary, split)[0].mean()
+            entry['toefl_delta'] = entry['toefl_accuracy'] - reference_accuracy
+            entry['within_tolerance'] = bool(abs(entry['toefl_delta']) <= tolerance)
+        if bless is not None: entry['bless_max_error'] = float(np.abs(bless_scores(bless, vocabulary, quantized) - reference_scores).max())
+        report.append(entry)
+    return report
@@ -1,18 +1,71 @@
 import os
 import re
+import hashlib
 
-def get_texts(startdir='/home/jovyan/kokos-playground/Data', ignore_list=[]):
-    file_list = []
-    ignore_list.append('readme.txt')
-    ignore_list.append('license.txt')
-    for dirpath, _, files in os.walk(startdir):
-        for file in files:
-            if file in ignore_list: continue
-            if file[-3:]=='txt':
-                file_list.append(os.path.join(dirpath, file))
-    return file_list
-
-def save_paths(file_list, save_dir='/home/jovyan/kokos-playground/Output/file_paths.txt'):
-    with open('/home/jovyan/kokos-playground/Output/file_paths.txt','w') as f:
+# corpus and output locations, configurable through the environment
+DATA_DIR = os.environ.get('SDE_DATA_DIR', '/home/jovyan/kokos-playground/Data')
+OUTPUT_DIR = os.environ.get('SDE_OUTPUT_DIR', '/home/jovyan/kokos-playground/Output')
+DEFAULT_IGNORE = ('readme.txt', 'license.txt')
+
+# the boundaries of vocabularize's sentences: the line breaks of str.splitlines and full stops
+_BOUNDARY = re.compile('[.\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+def get_texts(startdir=DATA_DIR, ignore_list=None):
+    # get_texts: the list of the .txt sample files under startdir (a directory or a list of directories), see iter_texts
+    return list(iter_texts(startdir, ignore_list))
+
+def iter_texts(startdir=DATA_DIR, ignore_list=None, shard_id=0, num_shards=1, extension='txt'):
+    # iter_texts: lazily yield the paths of the sample files under one or more root directories
+    # Inputs:
+    # - startdir: a root directory or a list of root directories
+    # - ignore_list: file names to skip, in addition to DEFAULT_IGNORE
+    # - shard_id, num_shards: yield only every num_shards-th file, starting from the shard_id-th, to split the corpus between workers
+    # - extension: the extension of the sample files
+    # Directories and files are visited in sorted order, so every worker sees the same sequence and the shards are disjoint.
+    if isinstance(startdir, str): startdir = [startdir]
+    ignore = set(DEFAULT_IGNORE).union(ignore_list or [])
+    position = 0
+    for root in startdir:
+        for dirpath, dirnames, files in os.walk(root):
+            dirnames.sort()
+            for file in sorted(files):
+                if file in ignore or not file.endswith(extension): continue
+                if position % num_shards == shard_id: yield os.path.join(dirpath, file)
+                position += 1
+
+def iter_sentences(startdir=DATA_DIR, ignore_list=None, shard_id=0, num_shards=1, min_tokens=4):
+    # iter_sentences: lazily yield (filepath, sentence) pairs over the sample files of a shard of the corpus, see iter_texts and read_sentences
+    for filepath in iter_texts(startdir, ignore_list, shard_id, num_shards):
+        for sentence in read_sentences(filepath, min_tokens):
+            yield filepath, sentence
+
+def save_paths(file_list, save_dir=os.path.join(OUTPUT_DIR, 'file_paths.txt')):
+    # save_paths: write the file paths, one per line, to the file save_dir
+    with open(save_dir,'w') as f:
         for file in file_list:
-            f.write(file+'\n')
\ No newline at end of file
+            f.write(file+'\n')
+
+def read_sentences(filepath, min_tokens=4, chunk_size=1 << 20):
+    # yield the sentences of a sample file, split on line breaks and full stops, skipping those shorter than min_tokens
+    # the file is read in chunks of chunk_size characters, so memory is bounded by the chunk and the longest sentence
+    with open(filepath.rstrip('\n')) as file:
+        remainder = ''
+        for chunk in iter(lambda: file.read(chunk_size), ''):
+            sentences = _BOUNDARY.split(remainder + chunk)
+            remainder = sentences.pop() # possibly continued in the next chunk
+            for sentence in sentences:
+                if len(sentence.split()) < min_tokens: continue
+                yield sentence
+        if len(remainder.split()) >= min_tokens: yield remainder
+
+def file_hash(filepath):
+    # the SHA-1 hex digest of the content of a file, read in blocks
+    digest = hashlib.sha1()
+    with open(filepath.rstrip('\n'), 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''): digest.update(block)
+    return digest.hexdigest()
+
+def shard_list(file_list, num_shards):
+    # split a file list into num_shards contiguous shards of (almost) equal length, preserving the order of the files
+    file_list = list(file_list)
+    return [file_list[ii*len(file_list)//num_shards:(ii+1)*len(file_list)//num_shards] for ii in range(num_shards)]
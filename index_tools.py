@@ -0,0 +1,125 @@
+# tools for approximate nearest neighbour search over embedding rows (an IVF index with a k-means coarse quantizer)
+import time
+import numpy as np
+from scipy import sparse
+from matrix_tools import normalize_rows, top_indices
+from vocabulary_tools import idx_to_words
+
+class IVFIndex:
+    '''
+    Inverted-file index for approximate cosine nearest neighbours: the normalized rows are clustered by spherical k-means into n_lists
+    lists and a query only scans the n_probe lists whose centroids are closest to it. n_probe trades recall for latency
+    (n_probe = n_lists is an exact search); use recall_report to choose it.
+    Inputs:
+    - vectors: a dense (V, D) embedding matrix, or a sparse one (densified), row ii being the word with ID ii
+    - n_lists: number of inverted lists, about sqrt(V) by default
+    - n_probe: default number of lists scanned per query
+    - n_iter: number of k-means iterations
+    - sample_size: number of rows the k-means is trained on
+    - seed: seed of the k-means initialisation and sampling
+    '''
+    def __init__(self, vectors, n_lists=None, n_probe=8, n_iter=10, sample_size=50000, seed=0, dtype=np.float32):
+        if sparse.issparse(vectors): vectors = vectors.toarray()
+        self.vectors = normalize_rows(vectors, dtype=dtype)
+        if n_lists is None: n_lists = max(1, int(np.sqrt(len(self.vectors))))
+        self.n_probe = n_probe
+        self.centroids = _spherical_kmeans(self.vectors, n_lists, n_iter, sample_size, seed)
+        assignments = self._nearest_lists(self.vectors, 1)[:, 0]
+        self.order = np.argsort(assignments, kind='stable').astype(np.int64) # row ids grouped by list
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Opens an index written by save (the .npz suffix is appended to path if missing, as save does).
+        '''
+        if not path.endswith('.npz'): path += '.npz'
+        index = cls.__new__(cls)
+        with np.load(path) as arrays:
+            index.vectors, index.centroids = arrays['vectors'], arrays['centroids']
+            index.order, index.offsets = arrays['order'], arrays['offsets']
+            index.n_probe = int(arrays['n_probe'])
+        return index
+
+    def save(self, path):
+        '''
+        Writes the index (normalized vectors, centroids and inverted lists) to a single .npz file; the suffix is appended to path if missing.
+        '''
+        if not path.endswith('.npz'): path += '.npz'
+        np.savez(path, vectors=self.vectors, centroids=self.centroids, order=self.order, offsets=self.offsets, n_probe=self.n_probe)
+
+    def search(self, queries, topn=10, n_probe=None):
+        '''
+        Finds the approximate topn neighbours of a batch of query vectors.
+        Inputs:
+        - queries: a (Q, D) matrix (or a single D vector)
+        - topn: number of neighbours
+        - n_probe: number of lists scanned, the default of the index if None
+        Outputs:
+        - ids (Q, topn) and cosine similarities (Q, topn), in order of decreasing similarity; missing neighbours have id -1
+        '''
+        queries = normalize_rows(np.atleast_2d(queries), dtype=self.vectors.dtype)
+        probes = self._nearest_lists(queries, n_probe or self.n_probe)
+        ids = np.full((len(queries), topn), -1, dtype=np.int64)
+        scores = np.full((len(queries), topn), -np.inf, dtype=self.vectors.dtype)
+        for ii, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.order[self.offsets[jj]:self.offsets[jj+1]] for jj in lists])
+            values = self.vectors[candidates] @ query
+            best = top_indices(values, topn)[:topn]
+            ids[ii, :len(best)] = candidates[best]
+            scores[ii, :len(best)] = values[best]
+        return ids, scores
+
+    def most_similar(self, word, vocabulary, reverse_vocabulary, topn=10, n_probe=None):
+        '''
+        Approximate most_similar: the (word, similarity) pairs of the topn neighbours of a vocabulary key.
+        '''
+        ids, scores = self.search(self.vectors[vocabulary[word][2]], topn, n_probe)
+        found = ids[0] >= 0
+        return list(zip(idx_to_words(ids[0][found], reverse_vocabulary), scores[0][found].tolist()))
+
+    def _nearest_lists(self, queries, n_probe):
+        similarities = queries @ self.centroids.T
+        n_probe = min(n_probe, len(self.centroids))
+        if n_probe == len(self.centroids): return np.argsort(-similarities, axis=1)
+        return np.argpartition(-similarities, n_probe - 1, axis=1)[:, :n_probe]
+
+def _spherical_kmeans(vectors, n_clusters, n_iter, sample_size, seed):
+    # k-means on the unit sphere (cosine similarity), trained on a random sample of the rows
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    n_clusters = min(n_clusters, len(sample))
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = ~sums.any(axis=1)
+        sums[empty] = sample[rng.choice(len(sample), empty.sum())] # reseed empty clusters
+        centroids = normalize_rows(sums, dtype=vectors.dtype)
+    return centroids
+
+def recall_report(index, queries=1000, topn=10, n_probes=(1, 2, 4, 8, 16, 32), seed=0):
+    '''
+    recall_report: measure the recall@topn and latency of an IVFIndex against the exact brute-force neighbours
+    Inputs:
+    - index: the IVFIndex
+    - queries: number of randomly chosen rows to query, or an array of row ids
+    - topn: the k of recall@k
+    - n_probes: the n_probe values to evaluate
+    - seed: seed of the query sampling
+    Outputs:
+    - a list of dictionaries with n_probe, recall (fraction of the exact topn found) and milliseconds per query, one per n_probe value
+    '''
+    if np.isscalar(queries):
+        queries = np.random.default_rng(seed).choice(len(index.vectors), min(queries, len(index.vectors)), replace=False)
+    vectors = index.vectors[queries]
+    exact = np.array([top_indices(index.vectors @ vector, topn)[:topn] for vector in vectors])
+    report = []
+    for n_probe in n_probes:
+        start = time.perf_counter()
+        ids, _ = index.search(vectors, topn, n_probe)
+        elapsed = time.perf_counter() - start
+        found = sum(len(np.intersect1d(approximate, truth)) for approximate, truth in zip(ids, exact))
+        report.append({'n_probe': n_probe, 'recall': found / float(exact.size), 'ms_per_query': 1000 * elapsed / len(vectors)})
+    return report
@@ -1,86 +1,643 @@
 # tools for co-occurrence matrix
+import collections
+import multiprocessing
 import numpy as np
-from scipy.spatial.distance import cosine
+from scipy import sparse
 from vocabulary_tools import idx_to_words
+from profiling_tools import PROFILER
 
-def construct_similarities(comatrix):
+def construct_similarities(comatrix, rows=None, block_size=1024, dtype=np.float64):
     '''
-    iterate over a matrix to produce word-pair similarities
+    Computes word-pair cosine similarities as tiled products of the row-normalized co-occurrence matrix.
+    Inputs:
+    - comatrix: a dense or scipy.sparse co-occurrence matrix of size (V, V)
+    - rows: optional list of row indices; if given, only the tiles covering these rows are computed
+    - block_size: number of rows per tile
+    - dtype: np.float32 or np.float64, the precision of the computation and of the output
+    Outputs:
+    - similarities: a dense matrix of size (V, V), or (len(rows), V) if rows is given
+    Rows of zero norm have zero similarity to every word (including themselves).
+    The output is allocated in full (V * V * 8 bytes for float64); use stream_similarities when it does not fit in memory.
     '''
-    similarities = np.zeros((comatrix.shape[0], comatrix.shape[0]))
-    for ii in range(comatrix.shape[0]):
-        for jj in range(ii, comatrix.shape[0]): # diagonal symmetry - fill only the upper right triangle
-            similarities[ii, jj] = 1 - cosine(comatrix[ii,:], comatrix[jj,:])
-            similarities[jj, ii] = similarities[ii, jj]
+    with PROFILER.stage('similarities'):
+        normalized = normalize_rows(comatrix, dtype=dtype)
+        if rows is None: rows = np.arange(normalized.shape[0])
+        else: rows = np.asarray(rows, dtype=np.int64)
+        similarities = np.empty((len(rows), normalized.shape[0]), dtype=dtype)
+        transposed = normalized.T
+        if not sparse.issparse(normalized): transposed = np.ascontiguousarray(transposed)
+        for start in range(0, len(rows), block_size):
+            block = normalized[rows[start:start+block_size]] @ transposed
+            if sparse.issparse(block): block = block.toarray()
+            similarities[start:start+block_size] = block
     return similarities
 
-def most_similar(word, vocabulary, reverse_vocabulary, similarities, return_similarities=False):
+def normalize_rows(comatrix, dtype=np.float64):
+	'''
+	Scales every row of a dense or scipy.sparse matrix to unit L2 norm; rows of zero norm are left as zeros.
+	Inputs:
+	- comatrix: a dense or scipy.sparse matrix
+	- dtype: the floating point type of the output
+	Outputs:
+	- the row-normalized matrix (CSR if the input was sparse, dense otherwise)
+	'''
+	if sparse.issparse(comatrix):
+		normalized = sparse.csr_matrix(comatrix, dtype=dtype, copy=True)
+		norms = np.sqrt(np.asarray(normalized.multiply(normalized).sum(axis=1), dtype=dtype).ravel())
+		norms[norms == 0] = 1
+		normalized.data /= np.repeat(norms, np.diff(normalized.indptr))
+		return normalized
+	normalized = np.array(comatrix, dtype=dtype)
+	norms = np.linalg.norm(normalized, axis=1)
+	norms[norms == 0] = 1
+	normalized /= norms[:, None]
+	return normalized
+
+def most_similar(word, vocabulary, reverse_vocabulary, similarities, return_similarities=False, topn=None):
+    '''
+    Ranks the vocabulary by similarity to a word.
+    Inputs:
+    - word: the vocabulary key of the word
+    - vocabulary, reverse_vocabulary: the vocabulary and its index -> key mapping
+    - similarities: a precomputed similarities matrix, or CosineSimilarities to compute the word's row on demand (wrapped in a
+      SimilarityCache to keep the rows of repeatedly queried words)
+    - return_similarities: if set to True, (word, similarity) pairs are returned instead of words
+    - topn: if given, only the topn most similar words are selected (with argpartition, without sorting the whole row)
+    Outputs:
+    - the words in order of decreasing similarity, or (word, similarity) pairs
+    '''
     ii = vocabulary[word][2]
-    vector = similarities[ii, :]
-    idx = np.argsort(vector * -1)
-    if return_similarities: return idx_to_words(idx, reverse_vocabulary)
+    vector = np.asarray(similarities[ii, :]).ravel()
+    idx = top_indices(vector, topn)
+    if return_similarities: return list(zip(idx_to_words(idx, reverse_vocabulary), vector[idx].tolist()))
     return idx_to_words(idx, reverse_vocabulary)
 
+def pair_similarity(word1, word2, vocabulary, similarities):
+	'''
+	Returns the similarity of two vocabulary keys from a similarities matrix (or CosineSimilarities, or a SimilarityCache).
+	'''
+	return similarities[vocabulary[word1][2], vocabulary[word2][2]]
+
+def most_similar_batch(words, vocabulary, reverse_vocabulary, similarities, topn=10):
+	'''
+	Finds the topn most similar words of a batch of words, computing all their similarity rows at once.
+	Inputs:
+	- words: a list of vocabulary keys
+	- vocabulary, reverse_vocabulary, similarities: as in most_similar
+	- topn: number of neighbours per word
+	Outputs:
+	- a list holding the (word, similarity) pairs of every word, in order of decreasing similarity
+	'''
+	indices = np.array([vocabulary[word][2] for word in words], dtype=np.int64)
+	vectors = np.asarray(similarities[indices, :]).reshape(len(indices), -1)
+	neighbours = []
+	for vector in vectors:
+		idx = top_indices(vector, topn)
+		neighbours.append(list(zip(idx_to_words(idx, reverse_vocabulary), vector[idx].tolist())))
+	return neighbours
+
+def top_indices(vector, topn=None):
+	'''
+	Returns the indices of the topn largest values of a vector in decreasing order (all of them if topn is None).
+	Only the topn candidates selected by argpartition are sorted.
+	'''
+	if topn is None or topn >= len(vector): return np.argsort(vector * -1)
+	candidates = np.argpartition(vector * -1, topn - 1)[:topn]
+	return candidates[np.argsort(vector[candidates] * -1)]
+
+class CosineSimilarities:
+	'''
+	On-demand cosine similarities between the rows of a co-occurrence (or embedding) matrix, indexed like a precomputed similarities matrix:
+	similarities[ii, :] computes one row, similarities[indices, :] a batch of rows and similarities[rows, cols] the similarities of
+	paired (broadcast) indices, all from the row-normalized matrix and without materializing the (V, V) similarities.
+	Inputs:
+	- comatrix: a dense or scipy.sparse matrix with one row per vocabulary word
+	- dtype: the floating point type of the computation
+	- normalized: set to True if the rows of comatrix already have unit norm
+	'''
+	PAIR_BLOCK = 1024 # number of pairs computed at once by pairs
+
+	def __init__(self, comatrix, dtype=np.float32, normalized=False):
+		if normalized: self.normalized = comatrix
+		else: self.normalized = normalize_rows(comatrix, dtype=dtype)
+		self.dtype = self.normalized.dtype
+		self.shape = (self.normalized.shape[0], self.normalized.shape[0])
+		if not sparse.issparse(self.normalized): self._transposed = np.ascontiguousarray(self.normalized.T)
+
+	def rows(self, indices):
+		'''
+		Computes the full similarity rows of the given indices as a dense (len(indices), V) array.
+		'''
+		PROFILER.count('similarity_rows', len(indices))
+		queries = self.normalized[np.asarray(indices, dtype=np.int64)]
+		if sparse.issparse(queries): return np.asarray(self.normalized @ queries.toarray().T).T # one sparse mat-vec per row
+		return queries @ self._transposed
+
+	def pairs(self, rows, cols):
+		'''
+		Computes the similarities of the equal-length index arrays rows and cols, pair by pair, PAIR_BLOCK pairs at a time so that the
+		gathered rows take at most 2 * PAIR_BLOCK rows of the normalized matrix.
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		values = np.empty(len(rows), dtype=self.dtype)
+		for start in range(0, len(rows), self.PAIR_BLOCK):
+			left = self.normalized[rows[start:start+self.PAIR_BLOCK]]
+			right = self.normalized[cols[start:start+self.PAIR_BLOCK]]
+			if sparse.issparse(left): values[start:start+self.PAIR_BLOCK] = np.asarray(left.multiply(right).sum(axis=1)).ravel()
+			else: np.einsum('ij,ij->i', left, right, out=values[start:start+self.PAIR_BLOCK])
+		return values
+
+	def __getitem__(self, index):
+		return index_similarities(self, index)
+
+class SimilarityCache:
+	'''
+	A bounded LRU cache of similarity rows and pairs, keyed by vocabulary ID, in front of a similarities source and indexed like it:
+	cache[ii, :] and cache[indices, :] return (and keep) full rows, cache[rows, cols] returns pair similarities, read from a cached
+	row when there is one and kept as single pairs otherwise. Rows and pairs share one memory budget and the least recently used
+	entries are evicted first. Pass the same cache to most_similar, pair_similarity, multifold_test and construct_bless so repeated
+	queries (popular words, overlapping TOEFL candidates, repeated BLESS roots) are computed once.
+	Inputs:
+	- similarities: a CosineSimilarities, or anything indexed like a similarities matrix (e.g. a memory-mapped one)
+	- max_bytes: the memory budget of the cached entries
+	'''
+	PAIR_BYTES = 100 # approximate memory of a cached pair, dictionary entry included
+
+	def __init__(self, similarities, max_bytes=1 << 28):
+		self.similarities = similarities
+		self.shape = similarities.shape
+		self.dtype = similarities.dtype
+		self.max_bytes = max_bytes
+		self.clear()
+
+	def clear(self):
+		'''
+		Drops every cached entry and resets the statistics.
+		'''
+		self._entries = collections.OrderedDict() # ii -> row, (ii, jj) -> value, least recently used first
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def stats(self):
+		'''
+		Returns the hits, misses and hit rate of the lookups so far, and the number and memory of the cached entries.
+		'''
+		lookups = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / float(lookups) if lookups else 0.,
+				'entries': len(self._entries), 'nbytes': self.nbytes}
+
+	def rows(self, indices):
+		'''
+		Returns the full similarity rows of the given indices as a dense (len(indices), V) array, computing the uncached ones in one batch.
+		Every index counts as one lookup: a miss the first time an uncached index appears in the batch, a hit otherwise.
+		'''
+		indices = np.asarray(indices, dtype=np.int64).ravel()
+		found = {}
+		missing = []
+		for ii in indices.tolist():
+			if ii in found: continue
+			if ii in self._entries:
+				self._entries.move_to_end(ii)
+				found[ii] = self._entries[ii]
+			else:
+				found[ii] = None
+				missing.append(ii)
+		self._record(len(indices) - len(missing), len(missing))
+		if missing:
+			computed = np.asarray(self.similarities[np.array(missing), :]).reshape(len(missing), -1)
+			for ii, row in zip(missing, computed):
+				found[ii] = row
+				self._store(ii, row.copy(), row.nbytes) # a copy, so the computed block is not kept alive by one row
+		return np.array([found[ii] for ii in indices.tolist()]).reshape(len(indices), self.shape[1])
+
+	def pairs(self, rows, cols):
+		'''
+		Returns the similarities of the equal-length index arrays rows and cols, pair by pair, computing the uncached ones in one batch.
+		Every pair counts as one lookup: a miss the first time an uncached pair appears in the batch, a hit otherwise.
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		values = np.empty(len(rows), dtype=self.dtype)
+		missing = collections.defaultdict(list) # (ii, jj) -> positions
+		for position, (ii, jj) in enumerate(zip(rows.tolist(), cols.tolist())):
+			if ii in self._entries:
+				self._entries.move_to_end(ii)
+				values[position] = self._entries[ii][jj]
+			elif (ii, jj) in self._entries:
+				self._entries.move_to_end((ii, jj))
+				values[position] = self._entries[ii, jj]
+			else: missing[ii, jj].append(position)
+		self._record(len(rows) - len(missing), len(missing))
+		if missing:
+			keys = list(missing)
+			computed = np.asarray(self.similarities[np.array([ii for ii, _ in keys]), np.array([jj for _, jj in keys])]).ravel()
+			for key, value in zip(keys, computed.tolist()):
+				values[missing[key]] = value
+				self._store(key, value, self.PAIR_BYTES)
+		return values
+
+	def __getitem__(self, index):
+		return index_similarities(self, index)
+
+	def _record(self, hits, misses):
+		self.hits += hits
+		self.misses += misses
+		PROFILER.count('similarity_cache_hits', hits)
+		PROFILER.count('similarity_cache_misses', misses)
+
+	def _store(self, key, value, nbytes):
+		if nbytes > self.max_bytes: return
+		if key in self._entries: return
+		self._entries[key] = value
+		self.nbytes += nbytes
+		while self.nbytes > self.max_bytes: # evict the least recently used entries
+			key, value = self._entries.popitem(last=False)
+			self.nbytes -= value.nbytes if isinstance(key, int) else self.PAIR_BYTES
+
+def index_similarities(similarities, index):
+	# index_similarities: the indexing of the on-demand similarities (objects with shape, rows and pairs): [ii, :] and [indices, :] select
+	# rows, [rows, cols] broadcast pairs
+	row, col = index if isinstance(index, tuple) else (index, slice(None))
+	if isinstance(row, slice): row = np.arange(similarities.shape[0])[row]
+	if isinstance(col, slice):
+		if np.ndim(row) == 0: return similarities.rows([row])[0][col]
+		return similarities.rows(row)[:, col]
+	row, col = np.broadcast_arrays(np.asarray(row), np.asarray(col))
+	values = similarities.pairs(row.ravel(), col.ravel()).reshape(row.shape)
+	if values.ndim == 0: return values[()]
+	return values
+
+def stream_similarities(comatrix, path=None, topk=None, memory_budget=1 << 30, processes=1, dtype=np.float32):
+	'''
+	Computes the cosine similarities out of core: the rows are computed in blocks by a process pool, and every block is either written
+	to a memory-mapped .npy file or reduced to its topk most similar words, so the (V, V) matrix is never held in memory.
+	Inputs:
+	- comatrix: a dense (possibly memory-mapped) or scipy.sparse co-occurrence (or embedding) matrix with one row per vocabulary word;
+	  it is read in blocks of rows and never copied as a whole (the forked processes share it)
+	- path: the .npy file the full (V, V) similarities are written to (required unless topk is given); with topk, the .npz file the
+	  TopKSimilarities are saved to, if given
+	- topk: if given, only the topk similarities of every row are kept (the word itself included) and a TopKSimilarities is returned
+	- memory_budget: bound in bytes on the memory of the blocks in flight over all processes: the normalized query rows, the rows of
+	  comatrix they are multiplied with and the block of similarities (and its argpartition with topk); the output lists of topk
+	  and a vector of row norms come on top
+	- processes: number of worker processes
+	- dtype: the floating point type of the computation and of the output
+	Outputs:
+	- the similarities memory-mapped read-only from path, or a TopKSimilarities; either can be passed as the similarities of
+	  most_similar, multifold_test and construct_bless
+	'''
+	if path is None and topk is None: raise ValueError('stream_similarities needs a path or a topk')
+	size, width = comatrix.shape
+	dtype = np.dtype(dtype)
+	row_bytes = dtype.itemsize * (3 * width + size) # per block row: a query row (and its scaling), a row of comatrix and a row of similarities
+	if topk is not None:
+		topk = min(topk, size)
+		row_bytes += (dtype.itemsize + np.dtype(np.int64).itemsize) * size # the argpartition of the block, and its negated copy
+	block_size = max(1, int(memory_budget // (processes * row_bytes)))
+	blocks = [(start, min(start + block_size, size)) for start in range(0, size, block_size)]
+	scales = row_norms(comatrix, block_size)
+	scales[scales > 0] = 1 / scales[scales > 0] # rows of zero norm have zero similarity to every word
+	if topk is None:
+		np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(size, size)).flush()
+	else:
+		indices = np.empty((size, topk), dtype=np.int32)
+		values = np.empty((size, topk), dtype=dtype)
+	options = {'scales': scales.astype(dtype), 'block_size': block_size, 'dtype': dtype, 'path': path, 'topk': topk}
+	if processes == 1:
+		_init_similarity_worker(comatrix, options)
+		results = (_similarity_block(block) + (None,) for block in blocks)
+		pool = None
+	else:
+		pool = multiprocessing.get_context('fork').Pool(processes, initializer=_init_similarity_process, initargs=(comatrix, options))
+		results = pool.imap_unordered(_similarity_block_process, blocks)
+	try:
+		for start, end, block_indices, block_values, recorded in results:
+			PROFILER.merge(recorded)
+			if topk is None: continue
+			indices[start:end] = block_indices
+			values[start:end] = block_values
+	finally:
+		if pool is not None: pool.terminate()
+		_similarity_worker.clear()
+	if topk is None: return np.load(path, mmap_mode='r')
+	topk_similarities = TopKSimilarities(indices, values)
+	if path is not None: topk_similarities.save(path)
+	return topk_similarities
+
+def row_norms(comatrix, block_size=1024):
+	'''
+	Computes the L2 norm of every row of a dense (possibly memory-mapped) or scipy.sparse matrix, reading it in blocks of rows.
+	'''
+	if sparse.issparse(comatrix):
+		comatrix = sparse.csr_matrix(comatrix, dtype=np.float64)
+		return np.sqrt(np.asarray(comatrix.multiply(comatrix).sum(axis=1)).ravel())
+	norms = np.empty(comatrix.shape[0])
+	for start in range(0, comatrix.shape[0], block_size):
+		block = np.asarray(comatrix[start:start+block_size], dtype=np.float64)
+		norms[start:start+block_size] = np.sqrt(np.einsum('ij,ij->i', block, block))
+	return norms
+
+_similarity_worker = {} # per-process state of stream_similarities: the matrix, the output memmap and the options
+
+def _init_similarity_worker(comatrix, options):
+	_similarity_worker['comatrix'] = comatrix
+	_similarity_worker['options'] = options
+	if options['topk'] is None: _similarity_worker['output'] = np.load(options['path'], mmap_mode='r+')
+
+def _init_similarity_process(comatrix, options):
+	# the initializer of a worker process: drop the stages and counters inherited from the parent
+	PROFILER.reset()
+	_init_similarity_worker(comatrix, options)
+
+def _similarity_block_process(block):
+	# _similarity_block in a worker process, sending back the counters recorded while computing the block
+	return _similarity_block(block) + (PROFILER.collect(),)
+
+def _similarity_block(block):
+	# the similarities of the rows start to end: the normalized query rows against comatrix, read in blocks of block_size rows
+	start, end = block
+	comatrix, options = _similarity_worker['comatrix'], _similarity_worker['options']
+	scales, dtype, topk = options['scales'], options['dtype'], options['topk']
+	PROFILER.count('similarity_blocks')
+	PROFILER.count('similarity_rows', end - start)
+	queries = comatrix[start:end]
+	if sparse.issparse(queries): queries = queries.toarray()
+	queries = np.asarray(queries, dtype=dtype) * scales[start:end, None]
+	rows = np.empty((end - start, comatrix.shape[0]), dtype=dtype)
+	for first in range(0, comatrix.shape[0], options['block_size']):
+		last = min(first + options['block_size'], comatrix.shape[0])
+		if sparse.issparse(comatrix): product = (comatrix[first:last].astype(dtype) @ queries.T).T
+		else: product = queries @ np.asarray(comatrix[first:last], dtype=dtype).T
+		rows[:, first:last] = product * scales[first:last]
+	if topk is None:
+		output = _similarity_worker['output']
+		output[start:end] = rows
+		output.flush()
+		return start, end, None, None
+	indices = np.argpartition(rows * -1, topk - 1, axis=1)[:, :topk]
+	values = np.take_along_axis(rows, indices, axis=1)
+	order = np.argsort(values * -1, axis=1, kind='stable')
+	return start, end, np.take_along_axis(indices, order, axis=1).astype(np.int32), np.take_along_axis(values, order, axis=1)
+
+class TopKSimilarities:
+	'''
+	The topk most similar words of every row, as computed by stream_similarities, indexed like a similarities matrix: rows are dense,
+	with fill in place of the similarities that were not kept. A pair found in neither of its two rows' lists has similarity fill;
+	the similarities are symmetric, so a pair kept in the list of its column word is found too.
+	Inputs:
+	- indices: a (V, topk) array, row ii holding the IDs of the topk words most similar to the word with ID ii, most similar first
+	- values: the (V, topk) similarities of indices
+	- fill: the similarity of the pairs that were not kept
+	'''
+	def __init__(self, indices, values, fill=0.):
+		self.indices = indices
+		self.values = values
+		self.fill = fill
+		self.dtype = values.dtype
+		self.shape = (len(indices), len(indices))
+
+	@classmethod
+	def load(cls, path, fill=0.):
+		'''
+		Opens the lists written by save (the .npz suffix is appended to path if missing, as save does).
+		'''
+		if not path.endswith('.npz'): path += '.npz'
+		with np.load(path) as arrays: return cls(arrays['indices'], arrays['values'], fill)
+
+	def save(self, path):
+		'''
+		Writes the indices and values to a single .npz file; the suffix is appended to path if missing.
+		'''
+		if not path.endswith('.npz'): path += '.npz'
+		np.savez(path, indices=self.indices, values=self.values)
+
+	def rows(self, indices):
+		'''
+		Returns the rows of the given indices as a dense (len(indices), V) array, fill outside the topk.
+		'''
+		indices = np.asarray(indices, dtype=np.int64).ravel()
+		rows = np.full((len(indices), self.shape[1]), self.fill, dtype=self.dtype)
+		np.put_along_axis(rows, self.indices[indices].astype(np.int64), self.values[indices], axis=1)
+		return rows
+
+	def pairs(self, rows, cols):
+		'''
+		Returns the similarities of the equal-length index arrays rows and cols, pair by pair, fill where neither list holds the pair.
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		values = np.full(len(rows), self.fill, dtype=self.dtype)
+		for first, second in ((cols, rows), (rows, cols)): # the list of the row word takes precedence
+			matches = self.indices[first] == second[:, None]
+			found = matches.any(axis=1)
+			values[found] = self.values[first[found], matches[found].argmax(axis=1)]
+		return values
+
+	def __getitem__(self, index):
+		return index_similarities(self, index)
+
 def naive_update(matrix, vocabulary, parsed, window_size=3):
 	# perform the positional co-occurrence counting to update the matrix
-	peak = np.inf
-	if matrix.dtype==np.uint16: peak = 65535
-	for ii, token in enumerate(parsed):
-		key = token.lemma_
-		if key not in vocabulary.keys(): continue
-		index = vocabulary[key][2]
-		startpoint = max([0, ii-window_size])
-		endpoint = min([len(parsed), ii+window_size+1])
-		span=parsed[startpoint:endpoint]
-		wordindexes = [] # indexes to change in the matrix
-		for jj, word in enumerate(span):
-			wordkey = word.lemma_
-			if wordkey not in vocabulary.keys(): continue
-			wordindexes.append(vocabulary[wordkey][2])
-		for wordindex in wordindexes:
-			#if index>wordindex: continue
-			#matrix[index_comatrix(matrix, index, wordindex, return_index=True)] += 1
-			if matrix[index,wordindex]< peak: matrix[index, wordindex] += 1
-		
-	return matrix
+	# matrix: a dense (V, V) array or an accumulator such as SparseCounts
+	PROFILER.count('sentences')
+	PROFILER.count('tokens', len(parsed))
+	rows, cols = [], [] # indexes to change in the matrix
+	with PROFILER.stage('context extraction'):
+		ids = lemma_ids(parsed, vocabulary)
+		for ii, index in enumerate(ids):
+			if index < 0: continue
+			for wordindex in ids[max(0, ii-window_size):ii+window_size+1]:
+				if wordindex < 0: continue
+				rows.append(index)
+				cols.append(wordindex)
+	return add_pairs(matrix, rows, cols)
+
+def lemma_ids(parsed, vocabulary):
+	# lemma_ids: the vocabulary index of every token lemma of a parsed sentence, -1 if it is not in the vocabulary, looked up in one
+	# batch for a Vocabulary
+	if hasattr(parsed, 'heads'): lemmas = parsed.lemmas
+	else: lemmas = [token.lemma_ for token in parsed]
+	if hasattr(vocabulary, 'ids'): return vocabulary.ids(lemmas).tolist()
+	return [vocabulary[lemma][2] if lemma in vocabulary else -1 for lemma in lemmas]
 
 def syntactic_update(matrix, vocabulary, parsed, update_method, symmetrical=False, debug=False):
 	'''
 	Updates matrix by adding the co-occurrences within the given parsed sentence.
 	Inputs:
-	- matrix: a co-occurrence matrix of size (len(vocabulary), len(vocabulary))
+	- matrix: a co-occurrence matrix of size (len(vocabulary), len(vocabulary)), dense or an accumulator such as SparseCounts
 	- vocabulary: the vocabulary
-	- parsed: a SpaCy-parsed sentence
-	- update_method: the method that should be used to count the co-occurrences
+	- parsed: a SpaCy-parsed sentence (or a parse_tools.CachedDoc)
+	- update_method: the method that should be used to count the co-occurrences; the deptree_* contexts are computed for the whole sentence at once by dependency_contexts
 	- symmetrical: if set to True, the dependency relations are stored symmetrically (i.e. if the co-occurrence count of word A with word B is incremented, then also the co-occurrence count of word B with word A will be incremented)
 	- debug: if set to True, the co-occurrenced will be printed instead of stored in the matrix
 	Outputs:
 	- the updated matrix
 	'''
-	peak = np.inf
-	if matrix.dtype==np.uint16: peak = 65535
-	if debug: contexts = {w.lemma_: [] for w in parsed if w.lemma_ in vocabulary}
-	else: contexts = {vocabulary[w.lemma_][2]: [] for w in parsed if w.lemma_ in vocabulary}
-	for ii, token in enumerate(parsed):
-		key = token.lemma_
-		if key not in vocabulary.keys(): continue
-		index = vocabulary[key][2]
-		wordindexes = update_method(vocabulary, token, debug) # indexes to change in the matrix
-		if debug: contexts[key].extend(wordindexes)
-		else: contexts[index].extend(wordindexes)
-		if symmetrical:
-			for wordindex in wordindexes:
-				if debug: contexts[wordindex].append(key)
-				else: contexts[wordindex].append(index)	
+	PROFILER.count('sentences')
+	PROFILER.count('tokens', len(parsed))
+	with PROFILER.stage('context extraction'):
+		sentence_contexts = None
+		if debug: keys = [token.lemma_ if token.lemma_ in vocabulary else None for token in parsed]
+		elif update_method in CONTEXT_METHODS.values():
+			name = update_method.__name__
+			arrays = sentence_arrays(parsed, vocabulary, noun_chunks=name == 'deptree_noun_chunks')
+			sentence_contexts = dependency_contexts(*arrays, methods=[name])[name]
+			keys = [index if index >= 0 else None for index in arrays[2]]
+		else: keys = [index if index >= 0 else None for index in lemma_ids(parsed, vocabulary)]
+		contexts = {key: [] for key in keys if key is not None}
+		for ii, key in enumerate(keys):
+			if key is None: continue
+			if sentence_contexts is not None: wordindexes = sentence_contexts[ii]
+			else: wordindexes = update_method(vocabulary, parsed[ii], debug) # indexes to change in the matrix
+			if PROFILER.enabled:
+				PROFILER.count('context_tokens')
+				PROFILER.count('contexts', len(wordindexes))
+			contexts[key].extend(wordindexes)
+			if symmetrical:
+				for wordindex in wordindexes: contexts[wordindex].append(key)
 	
+	rows, cols = [], []
 	for index, context in contexts.items():
 		context = set(context)
 		if debug: print(index, 'has context', context)
 		else:
-			for wordindex in context:
-				if matrix[index, wordindex] < peak: matrix[index, wordindex] += 1
+			rows.extend([index] * len(context))
+			cols.extend(context)
+	if debug: return matrix
+	return add_pairs(matrix, rows, cols)
+
+def add_pairs(matrix, rows, cols):
+	'''
+	Increments the co-occurrence count of every (row, col) pair by one.
+	Inputs:
+	- matrix: a dense co-occurrence matrix, or an accumulator exposing add(rows, cols) (e.g. SparseCounts, PairBuffer)
+	- rows, cols: equal-length sequences of matrix indices; repeated pairs are counted repeatedly
+	Outputs:
+	- the updated matrix
+	'''
+	if hasattr(matrix, 'add'):
+		matrix.add(rows, cols)
+		return matrix
+	return scatter_pairs(matrix, rows, cols)
+
+def scatter_pairs(matrix, rows, cols):
+	'''
+	Adds a whole batch of (row, col) pairs to a dense matrix in a single scatter.
+	Repeated pairs are merged first, so that dense uint16 matrices saturate at 65535 exactly as with per-cell increments.
+	Inputs:
+	- matrix: a dense co-occurrence matrix
+	- rows, cols: equal-length sequences of matrix indices
+	Outputs:
+	- the updated matrix
+	'''
+	rows = np.asarray(rows, dtype=np.int64)
+	cols = np.asarray(cols, dtype=np.int64)
+	if not len(rows): return matrix
+	with PROFILER.stage('matrix increments'):
+		cells, counts = np.unique(rows * matrix.shape[1] + cols, return_counts=True)
+		rows, cols = np.divmod(cells, matrix.shape[1])
+		if matrix.dtype==np.uint16:
+			peak = 65535
+			updated = matrix[rows, cols].astype(np.int64) + counts
+			if PROFILER.enabled: # cells reaching the peak in this batch, and the increments lost to saturation
+				PROFILER.count('saturated_cells', int(np.count_nonzero((updated >= peak) & (updated - counts < peak))))
+				PROFILER.count('saturated_increments', int(np.maximum(updated - peak, 0).sum()))
+			matrix[rows, cols] = np.minimum(updated, peak)
+		else: matrix[rows, cols] += counts.astype(matrix.dtype)
 	return matrix
 
+class PairBuffer:
+	'''
+	Buffers the (row, col) pairs produced by the update functions across many sentences and flushes them into the wrapped matrix in one scatter.
+	Pass the buffer in place of the matrix to naive_update / syntactic_update and call flush() once the corpus is consumed.
+	Inputs:
+	- matrix: a dense co-occurrence matrix, or an accumulator exposing add(rows, cols)
+	- capacity: number of buffered pairs that triggers a flush
+	'''
+	def __init__(self, matrix, capacity=1000000):
+		self.matrix = matrix
+		self.capacity = capacity
+		self._rows = []
+		self._cols = []
+		self._pending = 0
+
+	def add(self, rows, cols):
+		'''
+		Buffers a batch of (row, col) pairs, each counting as one co-occurrence.
+		'''
+		if not len(rows): return
+		self._rows.append(np.asarray(rows, dtype=np.int64))
+		self._cols.append(np.asarray(cols, dtype=np.int64))
+		self._pending += len(rows)
+		if self._pending >= self.capacity: self.flush()
+
+	def flush(self):
+		'''
+		Writes all buffered pairs into the wrapped matrix and returns it.
+		'''
+		if self._pending:
+			add_pairs(self.matrix, np.concatenate(self._rows), np.concatenate(self._cols))
+			self._rows = []
+			self._cols = []
+			self._pending = 0
+		return self.matrix
+
+class SparseCounts:
+	'''
+	Sparse co-occurrence accumulator for vocabularies too large for a dense (V, V) matrix.
+	Pairs are buffered as COO batches and merged into a CSR matrix every merge_every pairs; counts never saturate.
+	Inputs:
+	- size: the vocabulary size V
+	- dtype: np.int32 or np.int64, the type of the counts
+	- merge_every: number of buffered pairs that triggers a merge into the CSR matrix
+	'''
+	DTYPES = (np.dtype(np.int32), np.dtype(np.int64)) # sparse additions wrap around instead of saturating, so only wide types are accepted
+
+	def __init__(self, size, dtype=np.int64, merge_every=1000000):
+		if np.dtype(dtype) not in self.DTYPES: raise ValueError('SparseCounts counts in np.int32 or np.int64, not %s' % np.dtype(dtype))
+		self.shape = (size, size)
+		self.dtype = np.dtype(dtype)
+		self.merge_every = merge_every
+		self._counts = sparse.csr_matrix(self.shape, dtype=self.dtype)
+		self._rows = []
+		self._cols = []
+		self._pending = 0
+
+	def add(self, rows, cols):
+		'''
+		Buffers a batch of (row, col) pairs, each counting as one co-occurrence.
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		if not len(rows): return
+		self._rows.append(rows)
+		self._cols.append(cols)
+		self._pending += len(rows)
+		if self._pending >= self.merge_every: self._merge()
+
+	def _merge(self):
+		if not self._pending: return
+		rows = np.concatenate(self._rows)
+		cols = np.concatenate(self._cols)
+		with PROFILER.stage('matrix increments'):
+			batch = sparse.coo_matrix((np.ones(len(rows), dtype=self.dtype), (rows, cols)), shape=self.shape)
+			self._counts = (self._counts + batch.tocsr()).astype(self.dtype)
+		self._rows = []
+		self._cols = []
+		self._pending = 0
+
+	def tocsr(self):
+		'''
+		Returns the accumulated counts as a scipy.sparse.csr_matrix (shared, not copied).
+		'''
+		self._merge()
+		return self._counts
+
+	def __getitem__(self, index):
+		return self.tocsr()[index]
+
 def deptree_naive(vocabulary, token, debug=False):
 	'''
 	Generates the context for a token by traversing up the dependency tree and adding all ancestors along the way.	
@@ -181,3 +738,104 @@ def addWord(word, wordindexes, vocabulary, debug=False):
 	if key in vocabulary.keys():
 		if debug: wordindexes.append(key)
 		else: wordindexes.append(vocabulary[key][2])
+
+CONTEXT_METHODS = {'deptree_naive': deptree_naive, 'deptree_headchildren': deptree_headchildren, 'deptree_noun_chunks': deptree_noun_chunks}
+
+def sentence_arrays(parsed, vocabulary, noun_chunks=False):
+	'''
+	Extracts the arrays used by dependency_contexts from a parsed sentence.
+	Inputs:
+	- parsed: a SpaCy-parsed sentence, or a parse_tools.CachedDoc (whose columns are used directly)
+	- vocabulary: the vocabulary
+	- noun_chunks: if set to True, the noun chunks (needed by deptree_noun_chunks only) are extracted too
+	Outputs:
+	- heads: sentence-relative head index of every token
+	- deps: dependency label of every token
+	- ids: vocabulary index of every token lemma, -1 if it is not in the vocabulary
+	- chunks: the noun chunks as sentence-relative (start, end, root) triples, empty unless noun_chunks is set
+	'''
+	chunks = ()
+	if hasattr(parsed, 'heads'):
+		heads, deps, lemmas = parsed.heads.tolist(), parsed.deps, parsed.lemmas
+		if noun_chunks: chunks = parsed.chunks
+	else:
+		offset = parsed[0].i if len(parsed) else 0
+		heads = [token.head.i - offset for token in parsed]
+		deps = [token.dep_ for token in parsed]
+		lemmas = [token.lemma_ for token in parsed]
+		if noun_chunks: chunks = [(nc.start - offset, nc.end - offset, nc.root.i - offset) for nc in parsed.noun_chunks]
+	if hasattr(vocabulary, 'ids'): ids = vocabulary.ids(lemmas).tolist()
+	else: ids = [vocabulary[lemma][2] if lemma in vocabulary else -1 for lemma in lemmas]
+	return heads, deps, ids, chunks
+
+def dependency_contexts(heads, deps, ids, chunks=(), methods=tuple(CONTEXT_METHODS)):
+	'''
+	Computes the deptree_naive, deptree_headchildren and deptree_noun_chunks contexts of every token of a sentence in one pass over its arrays.
+	The output is identical to calling the corresponding deptree_* function on every token, without traversing SpaCy Token objects;
+	children and conjunct chains are indexed once and the noun chunk contexts are computed once per chunk.
+	Inputs:
+	- heads, deps, ids, chunks: the sentence arrays, as returned by sentence_arrays
+	- methods: names of the contexts to compute
+	Outputs:
+	- a dictionary mapping every method name to a list holding the context (a list of matrix indices) of every token
+	'''
+	length = len(heads)
+	children = [[] for _ in range(length)]
+	for child, head in enumerate(heads):
+		if child != head: children[head].append(child)
+	first_conj = [next((child for child in children[ii] if deps[child] == 'conj'), -1) for ii in range(length)]
+
+	def add(word, wordindexes):
+		if ids[word] >= 0: wordindexes.append(ids[word])
+
+	def add_children(words, wordindexes):
+		for child in words:
+			if deps[child] == 'prep' and children[child]: child = children[child][0] # skip the preposition, connect to its object
+			add(child, wordindexes)
+			conjunct = first_conj[child]
+			while conjunct != -1:
+				add(conjunct, wordindexes)
+				conjunct = first_conj[conjunct]
+
+	def add_head_conjuncts(word, wordindexes):
+		if deps[word] == 'pobj': word = heads[word] # skip the preposition, connect to its head
+		while deps[heads[word]] == 'conj' and heads[word] != word:
+			add(heads[word], wordindexes)
+			word = heads[word]
+		return word
+
+	contexts = {}
+	if 'deptree_naive' in methods:
+		ancestors = [None] * length # context of every token, shared with its descendants
+		def ancestry(word):
+			path = [] # the tokens between word and its first ancestor with a known context (or the root), walked iteratively
+			while ancestors[word] is None and deps[word] != 'ROOT' and heads[word] != word:
+				path.append(word)
+				word = heads[word]
+			if ancestors[word] is None: ancestors[word] = []
+			for word in reversed(path):
+				ancestors[word] = []
+				add(heads[word], ancestors[word])
+				ancestors[word].extend(ancestors[heads[word]])
+			return ancestors[word]
+		contexts['deptree_naive'] = [list(ancestry(ii)) for ii in range(length)]
+	if 'deptree_headchildren' in methods:
+		contexts['deptree_headchildren'] = []
+		for ii in range(length):
+			wordindexes = []
+			if deps[ii] != 'prep':
+				add_children(children[ii], wordindexes)
+				word = add_head_conjuncts(ii, wordindexes)
+				if deps[word] != 'ROOT': add(heads[word], wordindexes)
+			contexts['deptree_headchildren'].append(wordindexes)
+	if 'deptree_noun_chunks' in methods:
+		contexts['deptree_noun_chunks'] = [[] for _ in range(length)]
+		for start, end, root in chunks:
+			wordindexes = []
+			add_children([child for child in children[root] if not start <= child < end], wordindexes)
+			add(heads[add_head_conjuncts(root, wordindexes)], wordindexes)
+			for ii in range(start, end):
+				contexts['deptree_noun_chunks'][ii].extend(wordindexes)
+				for word in range(start, end): # all other words in the noun chunk
+					if word != ii: add(word, contexts['deptree_noun_chunks'][ii])
+	return contexts
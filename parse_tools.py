@@ -0,0 +1,198 @@
+# tools for caching spaCy parses on disk, so that the corpus is parsed once and reused by every context strategy
+import os
+import json
+import hashlib
+import importlib.metadata
+import numpy as np
+from explorer_tools import read_sentences, file_hash
+
+CACHE_FORMAT = 1
+
+class ParseCache:
+    '''
+    On-disk cache of parsed sample files, one compressed .npz of token columns per file.
+    Entries are keyed by the file path, a hash of its content and the parser version, so edited files and new models are re-parsed.
+    Inputs:
+    - directory: the cache directory (created if missing)
+    - nlp: a loaded spaCy model, or the name of a model that is loaded only when a file has to be parsed
+    - batch_size: number of sentences fed to nlp.pipe at once on a cache miss
+    '''
+    def __init__(self, directory, nlp, batch_size=1000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.batch_size = batch_size
+        self._nlp = nlp
+        self.version = parser_version(nlp)
+
+    @property
+    def nlp(self):
+        if isinstance(self._nlp, str):
+            import spacy
+            self._nlp = spacy.load(self._nlp)
+        return self._nlp
+
+    def path(self, filepath):
+        '''
+        Returns the location of the cache entry of a sample file.
+        '''
+        filepath = filepath.rstrip('\n')
+        key = '\n'.join([os.path.abspath(filepath), file_hash(filepath), self.version, str(CACHE_FORMAT)])
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    def docs(self, filepath):
+        '''
+        Yields the parsed sentences of a sample file as CachedDoc objects, parsing and storing the file on a cache miss.
+        '''
+        path = self.path(filepath)
+        if not os.path.exists(path):
+            columns = docs_to_columns(self.nlp.pipe(read_sentences(filepath), batch_size=self.batch_size))
+            temporary = path[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+            np.savez_compressed(temporary, **columns)
+            os.replace(temporary, path)
+        with np.load(path) as columns:
+            for doc in columns_to_docs(columns): yield doc
+
+def parser_version(nlp):
+    # parser_version: a string identifying the model that produced a parse, '<lang>_<name>-<version>' (e.g. 'en_core_web_sm-3.7.1')
+    # whether the model is given by its name, its directory or loaded, so that all of them share the cache entries
+    if isinstance(nlp, str):
+        meta_path = os.path.join(nlp, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f: meta = json.load(f)
+        else:
+            try: return nlp + '-' + importlib.metadata.version(nlp)
+            except importlib.metadata.PackageNotFoundError: return nlp
+    else: meta = getattr(nlp, 'meta', {})
+    name = '%s_%s' % (meta.get('lang', ''), meta.get('name', type(nlp).__name__))
+    if meta.get('version'): return name + '-' + meta['version']
+    return name
+
+def docs_to_columns(docs):
+    '''
+    docs_to_columns: flatten parsed sentences into the columnar cache format
+    Inputs:
+    - docs: an iterable of spaCy Doc objects, one per sentence
+    Outputs:
+    - a dictionary of numpy arrays: the string table, per-token string ids (text, lemma, pos, dep) and sentence-relative head indices,
+      sentence offsets, noun chunks as sentence-relative (start, end, root) triples and noun chunk offsets
+    '''
+    strings = {}
+    intern = lambda string: strings.setdefault(string, len(strings))
+    text, lemma, pos, dep, head, chunks = [], [], [], [], [], []
+    sent_offsets, chunk_offsets = [0], [0]
+    for doc in docs:
+        for token in doc:
+            text.append(intern(token.text))
+            lemma.append(intern(token.lemma_))
+            pos.append(intern(token.pos_))
+            dep.append(intern(token.dep_))
+            head.append(token.head.i)
+        try: noun_chunks = list(doc.noun_chunks)
+        except ValueError: noun_chunks = [] # no dependency parse available
+        chunks.extend((nc.start, nc.end, nc.root.i) for nc in noun_chunks)
+        sent_offsets.append(len(head))
+        chunk_offsets.append(len(chunks))
+    return {'strings': np.array(list(strings), dtype=str), 'text': np.array(text, dtype=np.int32),
+            'lemma': np.array(lemma, dtype=np.int32), 'pos': np.array(pos, dtype=np.int32),
+            'dep': np.array(dep, dtype=np.int32), 'head': np.array(head, dtype=np.int32),
+            'sent_offsets': np.array(sent_offsets, dtype=np.int64),
+            'chunks': np.array(chunks, dtype=np.int32).reshape(-1, 3),
+            'chunk_offsets': np.array(chunk_offsets, dtype=np.int64)}
+
+def columns_to_docs(columns):
+    # columns_to_docs: rebuild one CachedDoc per sentence from the columnar cache format
+    strings = columns['strings'].tolist()
+    lookup = lambda name: [strings[ii] for ii in columns[name].tolist()]
+    text, lemma, pos, dep = lookup('text'), lookup('lemma'), lookup('pos'), lookup('dep')
+    head = columns['head']
+    chunks = columns['chunks'].tolist()
+    sent_offsets = columns['sent_offsets'].tolist()
+    chunk_offsets = columns['chunk_offsets'].tolist()
+    for ii in range(len(sent_offsets) - 1):
+        start, end = sent_offsets[ii], sent_offsets[ii+1]
+        yield CachedDoc(text[start:end], lemma[start:end], pos[start:end], dep[start:end], head[start:end],
+                        chunks[chunk_offsets[ii]:chunk_offsets[ii+1]])
+
+class CachedDoc:
+    '''
+    A parsed sentence read from the cache, exposing the part of the spaCy Doc interface used by vocabularize and the matrix_tools update functions.
+    The token columns are also available directly: texts, lemmas, tags (POS), deps (lists of strings), heads (int array) and chunks ((start, end, root) triples).
+    '''
+    def __init__(self, texts, lemmas, tags, deps, heads, chunks):
+        self.texts = texts
+        self.lemmas = lemmas
+        self.tags = tags
+        self.deps = deps
+        self.heads = np.asarray(heads)
+        self.chunks = chunks
+        self._tokens = [CachedToken(self, ii) for ii in range(len(lemmas))]
+        self._children = None
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __iter__(self):
+        return iter(self._tokens)
+
+    def __getitem__(self, index):
+        return self._tokens[index]
+
+    @property
+    def noun_chunks(self):
+        for start, end, root in self.chunks: yield CachedSpan(self, start, end, root)
+
+    def children(self, index):
+        # children of every token, in document order as in spaCy
+        if self._children is None:
+            self._children = [[] for _ in self._tokens]
+            for child, head in enumerate(self.heads.tolist()):
+                if child != head: self._children[head].append(child)
+        return self._children[index]
+
+class CachedToken:
+    '''
+    A token of a CachedDoc with the spaCy Token attributes text, lemma_, pos_, dep_, head, children, i and doc.
+    '''
+    __slots__ = ('doc', 'i')
+
+    def __init__(self, doc, i):
+        self.doc = doc
+        self.i = i
+
+    text = property(lambda self: self.doc.texts[self.i])
+    lemma_ = property(lambda self: self.doc.lemmas[self.i])
+    pos_ = property(lambda self: self.doc.tags[self.i])
+    dep_ = property(lambda self: self.doc.deps[self.i])
+    head = property(lambda self: self.doc[int(self.doc.heads[self.i])])
+
+    @property
+    def children(self):
+        return (self.doc[child] for child in self.doc.children(self.i))
+
+    def __eq__(self, other):
+        return isinstance(other, CachedToken) and other.doc is self.doc and other.i == self.i
+
+    def __hash__(self):
+        return hash((id(self.doc), self.i))
+
+    def __repr__(self):
+        return self.text
+
+class CachedSpan:
+    '''
+    A noun chunk of a CachedDoc, supporting iteration, membership tests and root as spaCy's Span.
+    '''
+    def __init__(self, doc, start, end, root):
+        self.doc = doc
+        self.start = start
+        self.end = end
+        self.root = doc[root]
+
+    def __iter__(self):
+        return iter(self.doc[self.start:self.end])
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __contains__(self, token):
+        return token.doc is self.doc and self.start <= token.i < self.end
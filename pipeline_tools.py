@@ -0,0 +1,240 @@
+# tools for building co-occurrence matrices over a whole corpus with worker processes
+import os
+import json
+import queue
+import shutil
+import traceback
+import multiprocessing
+import numpy as np
+from scipy import sparse
+import matrix_tools
+import storage_tools
+from explorer_tools import read_sentences, shard_list, file_hash
+from parse_tools import ParseCache
+from profiling_tools import PROFILER
+
+UPDATE_METHODS = ['naive', 'deptree_naive', 'deptree_headchildren', 'deptree_noun_chunks']
+
+_worker = {} # per-process state: the spaCy model (or parse cache), the vocabulary and the counting options
+
+def build_matrix(file_list, vocabulary, nlp, method='naive', processes=1, dtype=np.uint16, sparse_counts=False,
+                 window_size=3, symmetrical=False, batch_size=1000, shards_per_process=4, cache_dir=None):
+    '''
+    build_matrix: parse a list of sample files and count their co-occurrences into a single matrix
+    Inputs:
+    - file_list: the paths of the sample files (e.g. from explorer_tools.get_texts, trailing newlines allowed)
+    - vocabulary: the vocabulary mapping lemmata to [TF, TDF, ID]
+    - nlp: the name of a spaCy model, loaded once by every worker, or an already loaded model (shared with the forked workers)
+    - method: 'naive' for naive_update, or the name of the deptree_* context used by syntactic_update
+    - processes: number of worker processes
+    - dtype: type of the counts; dense uint16 matrices saturate at 65535
+    - sparse_counts: if set to True, count into SparseCounts and return a scipy.sparse.csr_matrix; sparse counts are int64 unless
+      dtype is np.int32 or np.int64, since sparse sums wrap around instead of saturating
+    - window_size: window of naive_update
+    - symmetrical: symmetrical option of syntactic_update
+    - batch_size: number of sentences fed to nlp.pipe at once
+    - shards_per_process: the files are split into processes*shards_per_process contiguous shards, handed out to the workers as
+      they become free for load balancing
+    - cache_dir: if given, read the parses from a parse_tools.ParseCache in this directory instead of running the parser
+    Outputs:
+    - the co-occurrence matrix of size (len(vocabulary), len(vocabulary))
+    Every worker counts all its shards into a single matrix and sends it back once, so only one partial matrix per process crosses
+    process boundaries. The counts are integers (and clipped sums of non-negative counts do not depend on their order), so the result
+    does not depend on the number of workers.
+    Every path in file_list is counted, duplicates included; incremental_build identifies files by content hash and counts identical
+    files once, so the two disagree on a corpus with duplicate files.
+    '''
+    if method not in UPDATE_METHODS: raise ValueError('Unknown update method: ' + str(method))
+    dtype = count_dtype(dtype, sparse_counts)
+    options = {'method': method, 'dtype': dtype, 'sparse_counts': sparse_counts, 'window_size': window_size,
+               'symmetrical': symmetrical, 'batch_size': batch_size, 'cache_dir': cache_dir}
+    if processes == 1:
+        _init_worker(nlp, vocabulary, options)
+        return _finish(_count_shard(_new_matrix(len(vocabulary), options), file_list), options)
+    shards = [shard for shard in shard_list(file_list, processes * shards_per_process) if shard]
+    return _reduce(_run_workers(shards, processes, nlp, vocabulary, options), len(vocabulary), dtype, sparse_counts)
+
+def count_dtype(dtype, sparse_counts):
+    # count_dtype: the type the counts are accumulated in; sparse counts need a wide signed type (see matrix_tools.SparseCounts)
+    if sparse_counts and np.dtype(dtype) not in matrix_tools.SparseCounts.DTYPES: return np.dtype(np.int64)
+    return np.dtype(dtype)
+
+def incremental_build(file_list, vocabulary, nlp, checkpoint_dir, method='naive', checkpoint_every=100, processes=1,
+                      dtype=np.uint16, sparse_counts=False, window_size=3, symmetrical=False, batch_size=1000, cache_dir=None):
+    '''
+    incremental_build: build_matrix with periodic checkpoints, resuming from the last checkpoint and absorbing new files
+    Inputs:
+    - file_list: the paths of the sample files; files whose content hash is in the checkpoint manifest are skipped
+    - vocabulary, nlp, method, processes, dtype, sparse_counts, window_size, symmetrical, batch_size, cache_dir: as in build_matrix
+    - checkpoint_dir: directory of the checkpoints (created if missing)
+    - checkpoint_every: number of new files counted between two checkpoints
+    Outputs:
+    - the co-occurrence matrix over all processed files (the manifest of the last checkpoint lists them)
+    A checkpoint is a storage_tools model directory (vocabulary and counts) plus manifest.json; it becomes current only once the
+    LATEST file points to it, so a crash while checkpointing leaves the previous one usable. Files are identified by content hash:
+    identical files are counted once and an edited file is counted again as a new one.
+    '''
+    dtype = count_dtype(dtype, sparse_counts)
+    options = {'method': method, 'dtype': dtype.str, 'sparse_counts': sparse_counts, 'window_size': window_size,
+               'symmetrical': symmetrical}
+    total, manifest = load_checkpoint(checkpoint_dir, vocabulary, options)
+    if total is None:
+        if sparse_counts: total = sparse.csr_matrix((len(vocabulary), len(vocabulary)), dtype=dtype)
+        else: total = np.zeros((len(vocabulary), len(vocabulary)), dtype=dtype)
+    processed = set(manifest['files'])
+    pending = []
+    for filepath in file_list:
+        digest = file_hash(filepath)
+        if digest in processed: continue
+        processed.add(digest)
+        pending.append((digest, filepath.rstrip('\n')))
+    for start in range(0, len(pending), checkpoint_every):
+        chunk = pending[start:start+checkpoint_every]
+        partial = build_matrix([filepath for _, filepath in chunk], vocabulary, nlp, method, processes, dtype, sparse_counts,
+                               window_size, symmetrical, batch_size, cache_dir=cache_dir)
+        total = _accumulate(total, partial)
+        manifest['files'].update(chunk)
+        save_checkpoint(checkpoint_dir, vocabulary, total, manifest)
+    return total
+
+def save_checkpoint(checkpoint_dir, vocabulary, counts, manifest):
+    '''
+    save_checkpoint: write a new checkpoint directory, make it the current one and remove the older ones
+    '''
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    existing = _checkpoints(checkpoint_dir)
+    name = 'checkpoint-%06d' % (int(existing[-1].split('-')[1]) + 1 if existing else 0)
+    storage_tools.save_model(os.path.join(checkpoint_dir, name), vocabulary, counts)
+    with open(os.path.join(checkpoint_dir, name, 'manifest.json'), 'w') as f: json.dump(manifest, f, indent=1)
+    with open(os.path.join(checkpoint_dir, 'LATEST.tmp'), 'w') as f: f.write(name)
+    os.replace(os.path.join(checkpoint_dir, 'LATEST.tmp'), os.path.join(checkpoint_dir, 'LATEST'))
+    for old in _checkpoints(checkpoint_dir):
+        if old != name: shutil.rmtree(os.path.join(checkpoint_dir, old))
+
+def load_checkpoint(checkpoint_dir, vocabulary, options):
+    '''
+    load_checkpoint: read the current checkpoint of checkpoint_dir
+    Outputs:
+    - the counts (None if there is no checkpoint yet) and the manifest, whose 'files' map content hashes to paths
+    Raises a ValueError if the checkpoint was built with a different vocabulary or different counting options.
+    '''
+    latest = os.path.join(checkpoint_dir, 'LATEST')
+    if not os.path.exists(latest): return None, dict(options, files={})
+    with open(latest) as f: directory = os.path.join(checkpoint_dir, f.read().strip())
+    with open(os.path.join(directory, 'manifest.json')) as f: manifest = json.load(f)
+    if any(manifest[key] != value for key, value in options.items()):
+        raise ValueError('The checkpoint in %s was built with different options: %s' % (checkpoint_dir, {key: manifest[key] for key in options}))
+    stored = storage_tools.load_model(directory, mmap=False)
+    keys = list(vocabulary.keys())
+    if list(stored.vocabulary.keys()) != keys or any(stored.vocabulary[key][2] != vocabulary[key][2] for key in keys):
+        raise ValueError('The checkpoint in %s was built with a different vocabulary' % checkpoint_dir)
+    counts = stored.counts
+    if not sparse.issparse(counts): counts = np.array(counts)
+    return counts, manifest
+
+def _checkpoints(checkpoint_dir):
+    return sorted(name for name in os.listdir(checkpoint_dir) if name.startswith('checkpoint-'))
+
+def count_file(matrix, filepath, vocabulary, nlp, method='naive', window_size=3, symmetrical=False, batch_size=1000):
+    '''
+    count_file: parse one sample file and add its co-occurrences to matrix
+    Inputs:
+    - matrix: a dense co-occurrence matrix or an accumulator (SparseCounts, PairBuffer)
+    - filepath: path of the sample file
+    - vocabulary: the vocabulary
+    - nlp: the loaded spaCy model, or a parse_tools.ParseCache
+    - method, window_size, symmetrical, batch_size: as in build_matrix
+    Outputs:
+    - the updated matrix
+    '''
+    if isinstance(nlp, ParseCache): parses = nlp.docs(filepath)
+    else: parses = nlp.pipe(read_sentences(filepath), batch_size=batch_size)
+    for parsed in PROFILER.timed('parsing', parses):
+        if method == 'naive': matrix = matrix_tools.naive_update(matrix, vocabulary, parsed, window_size)
+        else: matrix = matrix_tools.syntactic_update(matrix, vocabulary, parsed, getattr(matrix_tools, method), symmetrical)
+    return matrix
+
+def _init_worker(nlp, vocabulary, options):
+    if options['cache_dir'] is not None: nlp = ParseCache(options['cache_dir'], nlp, options['batch_size'])
+    elif isinstance(nlp, str):
+        import spacy
+        nlp = spacy.load(nlp)
+    _worker['nlp'] = nlp
+    _worker['vocabulary'] = vocabulary
+    _worker['options'] = options
+
+def _new_matrix(size, options):
+    if options['sparse_counts']: return matrix_tools.SparseCounts(size, dtype=options['dtype'])
+    return matrix_tools.PairBuffer(np.zeros((size, size), dtype=options['dtype']))
+
+def _count_shard(matrix, file_list):
+    nlp, vocabulary, options = _worker['nlp'], _worker['vocabulary'], _worker['options']
+    for filepath in file_list:
+        count_file(matrix, filepath, vocabulary, nlp, options['method'], options['window_size'],
+                   options['symmetrical'], options['batch_size'])
+    return matrix
+
+def _finish(matrix, options):
+    if options['sparse_counts']: return matrix.tocsr()
+    return matrix.flush()
+
+def _work(tasks, results, nlp, vocabulary, options):
+    # the loop of a worker process: count the shards of the task queue until the None sentinel, then send back the single partial
+    # with the stages and counters recorded while counting it
+    try:
+        PROFILER.reset() # the stages and counters inherited from the parent
+        _init_worker(nlp, vocabulary, options)
+        matrix = _new_matrix(len(vocabulary), options)
+        for shard in iter(tasks.get, None): _count_shard(matrix, shard)
+        matrix = _finish(matrix, options)
+        results.put((matrix, PROFILER.collect()))
+    except Exception:
+        results.put(RuntimeError('A counting process failed:\n' + traceback.format_exc()))
+
+def _run_workers(shards, processes, nlp, vocabulary, options):
+    # yield the partial matrix of every worker process as it arrives
+    context = multiprocessing.get_context('fork')
+    tasks, results = context.Queue(), context.Queue()
+    for shard in shards: tasks.put(shard)
+    for _ in range(processes): tasks.put(None)
+    workers = [context.Process(target=_work, args=(tasks, results, nlp, vocabulary, options)) for _ in range(processes)]
+    for worker in workers: worker.start()
+    try:
+        for _ in workers:
+            while True:
+                try:
+                    partial = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if any(worker.exitcode not in (None, 0) for worker in workers): raise RuntimeError('A counting process died')
+            if isinstance(partial, Exception): raise partial
+            partial, recorded = partial
+            PROFILER.merge(recorded)
+            yield partial
+    finally:
+        for worker in workers:
+            if worker.is_alive(): worker.terminate()
+            worker.join()
+
+def _reduce(partials, size, dtype, sparse_counts):
+    # sum the partial matrices
+    if sparse_counts: total = sparse.csr_matrix((size, size), dtype=dtype)
+    else: total = np.zeros((size, size), dtype=dtype)
+    for partial in partials: total = _accumulate(total, partial)
+    return total
+
+def _accumulate(total, partial):
+    # add a partial matrix to the total; uint16 sums are clipped at 65535 as the single process counting would do
+    if sparse.issparse(total): return (total + partial).astype(total.dtype)
+    if total.dtype == np.uint16:
+        summed = total.astype(np.uint32)
+        summed += partial
+        if PROFILER.enabled: # as counting into the total would: cells reaching 65535 in the sum and not in the partial (whose own count
+            # covers them), less the cells of the partial that were already saturated in the total, and the increments lost to clipping
+            reached = (summed >= 65535) & (total < 65535) & (partial < 65535)
+            PROFILER.count('saturated_cells', int(np.count_nonzero(reached)) - int(np.count_nonzero((partial >= 65535) & (total >= 65535))))
+            PROFILER.count('saturated_increments', int((summed - 65535)[summed > 65535].sum()))
+        np.minimum(summed, 65535, out=summed)
+        total[:] = summed
+    else: total += partial
+    return total
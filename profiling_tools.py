@@ -0,0 +1,153 @@
+# tools for instrumenting the embedding pipeline: per-stage wall time, counters and the memory high-water mark
+import sys
+import json
+import time
+import logging
+import contextlib
+import collections
+try: import resource
+except ImportError: resource = None # not available on Windows
+
+'''
+The pipeline functions report to the module-level PROFILER, which is disabled by default: a disabled stage() returns a shared no-op
+context manager and count() returns immediately, so the instrumentation costs a method call per sentence (or per batch).
+Usage:
+    PROFILER.enable()
+    ... build the vocabulary and the matrix, evaluate ...
+    PROFILER.log() or PROFILER.to_json('profile.json')
+With processes > 1, every worker process of vocabularize, pipeline_tools and stream_similarities sends its stages and counters back
+with its results (collect) and the parent adds them to its own (merge): the stage seconds are then summed over the processes and can
+exceed the elapsed time.
+'''
+
+_DISABLED = contextlib.nullcontext()
+
+class Profiler:
+    '''
+    Collects the wall time and number of calls of named stages and the totals of named counters.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self, reset=True):
+        if reset: self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.started = time.perf_counter()
+
+    def stage(self, name):
+        '''
+        A context manager adding the wall time of its block to the stage name.
+        '''
+        if not self.enabled: return _DISABLED
+        return _Stage(self, name)
+
+    def count(self, name, amount=1):
+        '''
+        Adds amount to the counter name.
+        '''
+        if self.enabled: self.counters[name] += amount
+
+    def timed(self, name, iterable):
+        '''
+        Yields the items of iterable, adding the time spent producing them (e.g. parsing in nlp.pipe) to the stage name.
+        '''
+        if not self.enabled:
+            for item in iterable: yield item
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try: item = next(iterator)
+            except StopIteration: break
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+            yield item
+
+    def collect(self):
+        '''
+        Returns the per-stage seconds and calls and the counters recorded since the last reset (None if disabled) and resets them;
+        a worker process sends them back with its results.
+        '''
+        if not self.enabled: return None
+        recorded = {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+        self.reset()
+        return recorded
+
+    def merge(self, recorded):
+        '''
+        Adds the stages and counters returned by collect (in a worker process) to this profiler's.
+        '''
+        if recorded is None or not self.enabled: return
+        for name, seconds in recorded['seconds'].items(): self.seconds[name] += seconds
+        for name, calls in recorded['calls'].items(): self.calls[name] += calls
+        for name, value in recorded['counters'].items(): self.counters[name] += value
+
+    def report(self):
+        '''
+        Returns a dictionary with the elapsed time, the per-stage seconds and calls, the counters, the derived rates
+        (sentences/s, tokens/s, contexts per token) and the peak resident memory in MB (None where unavailable).
+        '''
+        elapsed = time.perf_counter() - self.started
+        counters = dict(self.counters)
+        rates = {}
+        if elapsed > 0 and 'sentences' in counters: rates['sentences_per_s'] = counters['sentences'] / elapsed
+        if elapsed > 0 and 'tokens' in counters: rates['tokens_per_s'] = counters['tokens'] / elapsed
+        if counters.get('context_tokens'): rates['contexts_per_token'] = counters.get('contexts', 0) / float(counters['context_tokens'])
+        return {'elapsed': elapsed, 'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds},
+                'counters': counters, 'rates': rates, 'peak_rss_mb': peak_rss_mb()}
+
+    def to_json(self, path=None):
+        '''
+        Returns the report as a JSON string, also writing it to path if given.
+        '''
+        report = json.dumps(self.report(), indent=1)
+        if path is not None:
+            with open(path, 'w') as f: f.write(report)
+        return report
+
+    def log(self, logger=None, level=logging.INFO):
+        '''
+        Writes the report to a logger (the 'syntax-driven-embeddings' logger by default), one line per stage and counter.
+        '''
+        logger = logger or logging.getLogger('syntax-driven-embeddings')
+        report = self.report()
+        logger.log(level, 'elapsed %.3fs, peak RSS %s MB', report['elapsed'], report['peak_rss_mb'])
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            logger.log(level, 'stage %s: %.3fs in %d calls', name, stage['seconds'], stage['calls'])
+        for name, value in sorted(report['counters'].items()): logger.log(level, 'counter %s: %d', name, value)
+        for name, value in sorted(report['rates'].items()): logger.log(level, 'rate %s: %.2f', name, value)
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.seconds[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+        return False
+
+def peak_rss_mb():
+    # peak_rss_mb: the memory high-water mark (peak resident set size) of this process in MB, None if unavailable
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return peak / 2. ** 20 # bytes on macOS, kilobytes elsewhere
+    return peak / 2. ** 10
+
+PROFILER = Profiler()
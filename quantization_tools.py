@@ -0,0 +1,157 @@
+# tools for compact storage of co-occurrence counts and similarities: lossless narrow counts, log-scaled counts and quantized similarities
+import numpy as np
+from scipy import sparse
+from matrix_tools import index_similarities
+
+'''
+Counting into a uint16 matrix saturates frequent pairs at 65535; count into int64 (or a matrix_tools.SparseCounts) instead and shrink the
+result for storage:
+- compact_counts: lossless, the narrowest unsigned type holding the largest count
+- LogCounts: the counts as uint8/uint16 codes of log(1 + count), with a bounded relative error and no saturation
+The similarities are stored as QuantizedSimilarities (int8 with one scale per row, a quarter of float32, or float16);
+evaluation_tools.quantization_report measures the effect on the TOEFL and BLESS evaluations. storage_tools.save_model and load_model store and open all three.
+'''
+
+UNSIGNED_TYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+def narrowest_uint(maximum):
+    # narrowest_uint: the smallest unsigned integer type holding the values 0 to maximum
+    for dtype in UNSIGNED_TYPES:
+        if maximum <= np.iinfo(dtype).max: return np.dtype(dtype)
+    raise ValueError('No unsigned integer type holds %s' % maximum)
+
+def compact_counts(counts):
+    '''
+    compact_counts: store a co-occurrence matrix in the narrowest unsigned integer type holding its largest count, without loss
+    Inputs:
+    - counts: a dense or scipy.sparse matrix of non-negative integer counts (or anything with a tocsr() method, e.g. SparseCounts)
+    Outputs:
+    - the counts as a dense array or a scipy.sparse.csr_matrix of the narrowest type
+    '''
+    if hasattr(counts, 'tocsr') and not sparse.issparse(counts): counts = counts.tocsr()
+    if sparse.issparse(counts):
+        counts = sparse.csr_matrix(counts)
+        values = counts.data
+    else: values = counts = np.asarray(counts)
+    if values.size and values.min() < 0: raise ValueError('compact_counts needs non-negative counts')
+    dtype = narrowest_uint(int(values.max()) if values.size else 0)
+    return counts.astype(dtype)
+
+class LogCounts:
+    '''
+    Co-occurrence counts stored as the unsigned integer codes round(scale * log(1 + count)), the scale mapping the largest count to the
+    largest code: any count is representable (no saturation) and every decoded non-zero count is within relative_error of the count.
+    Inputs:
+    - counts: a dense or scipy.sparse matrix of non-negative counts (or anything with a tocsr() method)
+    - dtype: np.uint16 (relative error below 0.05% for counts up to 10**9) or np.uint8 (below 10%)
+    '''
+    def __init__(self, counts, dtype=np.uint16):
+        if hasattr(counts, 'tocsr') and not sparse.issparse(counts): counts = counts.tocsr()
+        if sparse.issparse(counts):
+            counts = sparse.csr_matrix(counts, dtype=np.float64)
+            values = counts.data
+        else: values = counts = np.asarray(counts, dtype=np.float64)
+        if values.size and values.min() < 0: raise ValueError('LogCounts needs non-negative counts')
+        maximum = np.log1p(values.max()) if values.size else 0.
+        self.scale = float(np.iinfo(dtype).max / maximum) if maximum > 0 else 1.
+        codes = np.rint(np.log1p(values) * self.scale).astype(dtype)
+        if sparse.issparse(counts): self.codes = sparse.csr_matrix((codes, counts.indices, counts.indptr), shape=counts.shape)
+        else: self.codes = codes
+        self.shape = counts.shape
+
+    @classmethod
+    def from_codes(cls, codes, scale):
+        '''
+        Wraps stored codes and their scale, e.g. as written by storage_tools.save_model.
+        '''
+        log_counts = cls.__new__(cls)
+        log_counts.codes, log_counts.scale, log_counts.shape = codes, float(scale), codes.shape
+        return log_counts
+
+    @property
+    def relative_error(self):
+        # the largest relative error of a decoded count of at least 1: the codes are within 0.5 of scale * log(1 + count), so the decoded
+        # count is within expm1(0.5 / scale) * (1 + count) of the count, and 1 + count <= 2 * count
+        return float(2 * np.expm1(0.5 / self.scale))
+
+    @property
+    def nbytes(self):
+        if sparse.issparse(self.codes): return self.codes.data.nbytes + self.codes.indices.nbytes + self.codes.indptr.nbytes
+        return self.codes.nbytes
+
+    def decode(self, dtype=np.float64):
+        '''
+        Returns the approximate counts as a dense array or a scipy.sparse.csr_matrix of dtype.
+        '''
+        if sparse.issparse(self.codes):
+            values = np.expm1(self.codes.data / self.scale).astype(dtype)
+            return sparse.csr_matrix((values, self.codes.indices, self.codes.indptr), shape=self.shape)
+        return np.expm1(self.codes / self.scale).astype(dtype)
+
+    def tocsr(self):
+        # the approximate counts as a scipy.sparse.csr_matrix, so LogCounts can be passed to reduction_tools.ppmi and embed
+        return sparse.csr_matrix(self.decode())
+
+class QuantizedSimilarities:
+    '''
+    Similarities stored with bounded precision loss and indexed like a similarities matrix (dequantized on access, as float32):
+    - np.int8: each row is scaled by the largest absolute similarity in it, so the error is at most that value / 254 (below 0.004
+      for cosine similarities) and the storage a quarter of float32
+    - np.float16: a relative error below 0.05% and half the storage of float32
+    Inputs:
+    - similarities: a similarities matrix (in memory or memory-mapped), or anything indexed like one (CosineSimilarities,
+      TopKSimilarities), read in blocks of rows
+    - dtype: np.int8 or np.float16
+    - block_size: number of rows quantized at once
+    - path: if given, the codes are written to this .npy file and memory-mapped instead of held in memory
+    '''
+    def __init__(self, similarities, dtype=np.int8, block_size=1024, path=None):
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype(np.int8), np.dtype(np.float16)): raise ValueError('Unsupported quantization type %s' % dtype)
+        self.shape = tuple(similarities.shape)
+        if path is None: self.codes = np.empty(self.shape, dtype=dtype)
+        else: self.codes = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=self.shape)
+        self.scales = np.ones(self.shape[0], dtype=np.float32)
+        for start in range(0, self.shape[0], block_size):
+            end = min(start + block_size, self.shape[0])
+            rows = np.asarray(similarities[start:end, :], dtype=np.float32).reshape(end - start, self.shape[1])
+            if dtype == np.int8:
+                scales = np.abs(rows).max(axis=1) / 127 if rows.size else np.ones(end - start, dtype=np.float32)
+                scales[scales == 0] = 1
+                self.scales[start:end] = scales
+                rows = np.rint(rows / scales[:, None])
+            self.codes[start:end] = rows.astype(dtype)
+        if path is not None: self.codes.flush()
+        self.dtype = np.dtype(np.float32)
+
+    @classmethod
+    def from_codes(cls, codes, scales):
+        '''
+        Wraps stored codes and row scales, e.g. as written by storage_tools.save_model.
+        '''
+        quantized = cls.__new__(cls)
+        quantized.codes, quantized.scales = codes, np.asarray(scales, dtype=np.float32)
+        quantized.shape, quantized.dtype = tuple(codes.shape), np.dtype(np.float32)
+        return quantized
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def rows(self, indices):
+        '''
+        Returns the dequantized rows of the given indices as a dense (len(indices), V) float32 array.
+        '''
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        return self.codes[indices].astype(np.float32) * self.scales[indices, None]
+
+    def pairs(self, rows, cols):
+        '''
+        Returns the dequantized similarities of the equal-length index arrays rows and cols, pair by pair.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        return self.codes[rows, cols].astype(np.float32) * self.scales[rows]
+
+    def __getitem__(self, index):
+        return index_similarities(self, index)
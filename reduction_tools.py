@@ -0,0 +1,75 @@
+# tools for turning raw co-occurrence counts into dense low-rank embeddings (PPMI weighting and truncated SVD)
+import numpy as np
+from scipy import sparse
+
+'''
+The dense embeddings replace the (V, V) counts downstream: wrap them in matrix_tools.CosineSimilarities and pass that as the similarities
+of most_similar, multifold_test and construct_bless.
+References:
+1) 'Improving Distributional Similarity with Lessons Learned from Word Embeddings' - Levy, Goldberg, Dagan
+2) 'Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions' - Halko, Martinsson, Tropp
+'''
+
+def ppmi(counts, alpha=0.75, shift=1.0, dtype=np.float32):
+    '''
+    ppmi: weight a co-occurrence matrix by its positive pointwise mutual information, keeping it sparse
+    Inputs:
+    - counts: a dense or scipy.sparse (V, V) co-occurrence matrix (or anything with a tocsr() method, e.g. SparseCounts)
+    - alpha: context distribution smoothing exponent, the context probabilities are taken proportional to count(c)**alpha (1 for no smoothing)
+    - shift: the PMI values are shifted by -log(shift) before clipping at zero (1 for no shift)
+    - dtype: the floating point type of the output
+    Outputs:
+    - the PPMI matrix as a scipy.sparse.csr_matrix; only positive entries are stored
+    '''
+    if hasattr(counts, 'tocsr') and not sparse.issparse(counts): counts = counts.tocsr()
+    counts = sparse.csr_matrix(counts, dtype=np.float64, copy=True) # a copy: eliminate_zeros below must not compact the caller's arrays
+    counts.eliminate_zeros()
+    total = counts.data.sum()
+    word_probabilities = np.asarray(counts.sum(axis=1)).ravel() / total
+    context_counts = np.asarray(counts.sum(axis=0)).ravel() ** alpha
+    context_probabilities = context_counts / context_counts.sum()
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    values = np.log(counts.data / total) - np.log(word_probabilities[rows]) - np.log(context_probabilities[counts.indices]) - np.log(shift)
+    weighted = sparse.csr_matrix((np.maximum(values, 0).astype(dtype), counts.indices, counts.indptr), shape=counts.shape)
+    weighted.eliminate_zeros()
+    return weighted
+
+def randomized_svd(matrix, rank, oversamples=10, n_iter=4, seed=0):
+    '''
+    randomized_svd: truncated SVD of a dense or sparse matrix by randomized range finding with power iterations
+    Inputs:
+    - matrix: a dense or scipy.sparse matrix
+    - rank: number of singular triplets to compute
+    - oversamples: extra random directions, improving the accuracy of the range
+    - n_iter: number of power iterations (more for slowly decaying spectra)
+    - seed: seed of the random projection, making the result reproducible
+    Outputs:
+    - U (n_rows, rank), s (rank,), Vt (rank, n_cols), with the singular values in decreasing order
+    '''
+    rng = np.random.default_rng(seed)
+    size = min(rank + oversamples, min(matrix.shape))
+    basis = matrix @ rng.standard_normal((matrix.shape[1], size))
+    for _ in range(n_iter): # normalized power iterations
+        basis, _ = np.linalg.qr(basis)
+        basis, _ = np.linalg.qr(matrix.T @ basis)
+        basis = matrix @ basis
+    basis, _ = np.linalg.qr(np.asarray(basis))
+    projected = np.asarray((matrix.T @ basis).T) # basis.T @ matrix, without transposing a sparse matrix product
+    U, s, Vt = np.linalg.svd(projected, full_matrices=False)
+    return (basis @ U)[:, :rank], s[:rank], Vt[:rank]
+
+def embed(counts, dimension=300, alpha=0.75, shift=1.0, eigenvalue_weight=0.5, n_iter=4, seed=0, dtype=np.float32):
+    '''
+    embed: reduce a co-occurrence matrix to dense word embeddings: PPMI weighting, then a truncated randomized SVD
+    Inputs:
+    - counts: a dense or scipy.sparse (V, V) co-occurrence matrix
+    - dimension: the embedding dimension
+    - alpha, shift: as in ppmi
+    - eigenvalue_weight: the embeddings are U * s**eigenvalue_weight (0 for U alone, 1 for the rank-reduced PPMI rows)
+    - n_iter, seed: as in randomized_svd
+    - dtype: the floating point type of the embeddings
+    Outputs:
+    - a dense (V, dimension) matrix, row ii being the embedding of the word with ID ii
+    '''
+    U, s, _ = randomized_svd(ppmi(counts, alpha, shift), dimension, n_iter=n_iter, seed=seed)
+    return (U * s ** eigenvalue_weight).astype(dtype)
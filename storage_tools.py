@@ -0,0 +1,105 @@
+# tools for storing vocabularies, co-occurrence counts and similarities in a memory-mappable on-disk format
+import os
+import json
+import collections
+import numpy as np
+from scipy import sparse
+from vocabulary_tools import Vocabulary
+from quantization_tools import LogCounts, QuantizedSimilarities
+
+'''
+A model directory holds one .npy file per array and a meta.json describing them:
+- keys.npy, vocabulary.npy: the vocabulary keys and their [TF, TDF, ID] rows
+- counts.npy (dense) or counts_data.npy, counts_indices.npy, counts_indptr.npy (CSR): the co-occurrence counts, optional; for
+  quantization_tools.LogCounts these hold the codes and meta.json their scale
+- similarities.npy: the similarities matrix, optional; for quantization_tools.QuantizedSimilarities it holds the codes and
+  similarities_scales.npy the row scales
+meta.json is written last, so a directory without it is an incomplete save.
+Arrays are opened with np.load(mmap_mode='r'): loading is almost instant and processes opening the same model share its pages.
+'''
+
+FORMAT_NAME = 'syntax-driven-embeddings'
+FORMAT_VERSION = 2 # 2: LogCounts and QuantizedSimilarities
+
+StoredModel = collections.namedtuple('StoredModel', ['vocabulary', 'reverse_vocabulary', 'counts', 'similarities', 'meta'])
+
+def save_model(directory, vocabulary, counts=None, similarities=None):
+    '''
+    save_model: store a vocabulary and optionally its co-occurrence counts and similarities in a model directory
+    Inputs:
+    - directory: the model directory (created if missing, existing arrays are overwritten)
+    - vocabulary: a Vocabulary or a mapping of keys to [TF, TDF, ID] arrays
+    - counts: a dense or scipy.sparse co-occurrence matrix, a matrix_tools.SparseCounts or a quantization_tools.LogCounts
+      (see also quantization_tools.compact_counts)
+    - similarities: a dense similarities matrix or a quantization_tools.QuantizedSimilarities
+    '''
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path): os.remove(meta_path)
+    keys = list(vocabulary.keys())
+    np.save(os.path.join(directory, 'keys.npy'), np.array(keys, dtype=str))
+    np.save(os.path.join(directory, 'vocabulary.npy'), np.array([vocabulary[key] for key in keys], dtype=np.int64).reshape(-1, 3))
+    meta = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'size': len(keys), 'counts': None, 'similarities': None}
+    if counts is not None:
+        encoding = None
+        if isinstance(counts, LogCounts): counts, encoding = counts.codes, {'kind': 'log', 'scale': counts.scale}
+        elif hasattr(counts, 'tocsr'): counts = counts.tocsr()
+        if sparse.issparse(counts):
+            counts.sort_indices()
+            for name in ('data', 'indices', 'indptr'): np.save(os.path.join(directory, 'counts_' + name + '.npy'), getattr(counts, name))
+            meta['counts'] = {'kind': 'csr', 'shape': list(counts.shape), 'dtype': counts.dtype.str}
+        else:
+            np.save(os.path.join(directory, 'counts.npy'), np.asarray(counts))
+            meta['counts'] = {'kind': 'dense', 'shape': list(counts.shape), 'dtype': np.asarray(counts).dtype.str}
+        meta['counts']['encoding'] = encoding
+    if similarities is not None:
+        if isinstance(similarities, QuantizedSimilarities):
+            np.save(os.path.join(directory, 'similarities.npy'), similarities.codes)
+            np.save(os.path.join(directory, 'similarities_scales.npy'), similarities.scales)
+            meta['similarities'] = {'kind': 'quantized', 'shape': list(similarities.shape), 'dtype': similarities.codes.dtype.str}
+        else:
+            np.save(os.path.join(directory, 'similarities.npy'), np.asarray(similarities))
+            meta['similarities'] = {'kind': 'dense', 'shape': list(similarities.shape), 'dtype': np.asarray(similarities).dtype.str}
+    with open(meta_path, 'w') as f: json.dump(meta, f, indent=1)
+
+def load_model(directory, mmap=True):
+    '''
+    load_model: open a model directory written by save_model
+    Inputs:
+    - directory: the model directory
+    - mmap: if set to True the counts and similarities are memory-mapped read-only instead of read into memory
+    Outputs:
+    - a StoredModel with the Vocabulary, the ID -> key mapping, the counts (np.memmap or scipy.sparse.csr_matrix over memory-mapped arrays,
+      a LogCounts over them if so stored, None if not stored), the similarities (a QuantizedSimilarities if so stored, None if not stored)
+      and the metadata
+    '''
+    meta = read_meta(directory)
+    mmap_mode = 'r' if mmap else None
+    keys = np.load(os.path.join(directory, 'keys.npy')).tolist()
+    rows = np.load(os.path.join(directory, 'vocabulary.npy'))
+    vocabulary = Vocabulary(keys, rows)
+    reverse_vocabulary = dict(zip(rows[:, 2].tolist(), keys))
+    counts = None
+    if meta['counts'] is not None:
+        if meta['counts']['kind'] == 'csr':
+            data, indices, indptr = [np.load(os.path.join(directory, 'counts_' + name + '.npy'), mmap_mode=mmap_mode)
+                                     for name in ('data', 'indices', 'indptr')]
+            counts = sparse.csr_matrix((data, indices, indptr), shape=tuple(meta['counts']['shape']), copy=False)
+        else: counts = np.load(os.path.join(directory, 'counts.npy'), mmap_mode=mmap_mode)
+        encoding = meta['counts'].get('encoding')
+        if encoding is not None and encoding['kind'] == 'log': counts = LogCounts.from_codes(counts, encoding['scale'])
+    similarities = None
+    if meta['similarities'] is not None:
+        similarities = np.load(os.path.join(directory, 'similarities.npy'), mmap_mode=mmap_mode)
+        if meta['similarities']['kind'] == 'quantized':
+            similarities = QuantizedSimilarities.from_codes(similarities, np.load(os.path.join(directory, 'similarities_scales.npy')))
+    return StoredModel(vocabulary, reverse_vocabulary, counts, similarities, meta)
+
+def read_meta(directory):
+    # read_meta: read and check the metadata of a model directory
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path): raise IOError('Not a model directory (or an incomplete save): ' + directory)
+    with open(meta_path) as f: meta = json.load(f)
+    if meta.get('format') != FORMAT_NAME or meta.get('version', 0) > FORMAT_VERSION:
+        raise IOError('Unsupported model format %s version %s in %s' % (meta.get('format'), meta.get('version'), directory))
+    return meta
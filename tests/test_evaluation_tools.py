@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+import evaluation_tools
+import matrix_tools
+
+def reference_multifold_test(tests, similarities, vocabulary, split=10):
+    # the original test loop
+    results = np.zeros([split])
+    current_index, batch_size, num_errors = 0, 0, 0.0
+    batch_sizes, num_errorss = [], []
+    for ii in range(len(tests)):
+        if current_index != int(ii/(len(tests)/split)):
+            results[current_index] = (batch_size - num_errors)/batch_size
+            batch_sizes.append(batch_size)
+            num_errorss.append(num_errors)
+            current_index = int(ii/(len(tests)/split))
+            batch_size, num_errors = 0, 0.0
+        test = tests.iloc[ii]
+        original = vocabulary[test.iloc[0]][2]
+        sims = np.array([similarities[original, vocabulary[test.iloc[jj+1]][2]] for jj in range(4)])
+        if np.argsort(sims * -1)[0] != 0: num_errors += 1
+        batch_size += 1
+    results[split-1] = (batch_size-num_errors)/batch_size
+    return results, batch_sizes, num_errorss
+
+@pytest.mark.parametrize('n_tests,split', [(80, 10), (77, 10), (23, 4)])
+def test_multifold_test_matches_loop(n_tests, split):
+    rng = np.random.default_rng(n_tests)
+    size = 50
+    vocabulary = {'w%d' % ii: np.array([100, 1, ii]) for ii in range(size)}
+    similarities = rng.random((size, size))
+    tests = pd.DataFrame([['w%d' % word for word in rng.choice(size, 5, replace=False)] for _ in range(n_tests)],
+                         columns=['original', 'ground_truth', 'test_1', 'test_2', 'test_3'])
+    results, batch_sizes, num_errors = evaluation_tools.multifold_test(tests, similarities, vocabulary, split)
+    expected_results, expected_sizes, expected_errors = reference_multifold_test(tests, similarities, vocabulary, split)
+    assert np.array_equal(results, expected_results)
+    assert batch_sizes == expected_sizes and num_errors == expected_errors
+
+def test_summarize_rejects_incomplete_roots():
+    rows = [(root, category, 'w', float(ii)) for ii, (root, category) in
+            enumerate((root, category) for root in ('a', 'b') for category in evaluation_tools.BLESS_CATEGORIES)]
+    bless = pd.DataFrame(rows, columns=['root', 'category', 'word', 'score'])
+    assert list(evaluation_tools.summarize(bless)) == ['a', 'b']
+    with pytest.raises(ValueError): evaluation_tools.summarize(bless[~((bless['root'] == 'b') & (bless['category'] == 'mero'))])
+
+@pytest.mark.parametrize('as_sparse', [False, True])
+def test_bless_scores_on_demand_match_precomputed(as_sparse):
+    rng = np.random.default_rng(0)
+    size, n_pairs = 60, 2500 # more pairs than CosineSimilarities.PAIR_BLOCK
+    counts = rng.integers(0, 5, (size, size)) * (rng.random((size, size)) < 0.3)
+    vocabulary = {'w%d' % ii: np.array([100, 1, ii]) for ii in range(size)}
+    bless = pd.DataFrame({'root': ['w%d' % ii for ii in rng.integers(size, size=n_pairs)], 'category': 'coord',
+                          'word': ['w%d' % ii for ii in rng.integers(size, size=n_pairs)], 'score': 0.})
+    expected = evaluation_tools.bless_scores(bless, vocabulary, matrix_tools.construct_similarities(counts))
+    on_demand = matrix_tools.CosineSimilarities(sparse.csr_matrix(counts) if as_sparse else counts, dtype=np.float64)
+    assert np.allclose(evaluation_tools.bless_scores(bless, vocabulary, on_demand), expected)
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import cosine
+import benchmark_tools
+import matrix_tools
+
+# the original per-cell implementations, the reference of the vectorized ones
+
+def reference_similarities(comatrix):
+    similarities = np.zeros((comatrix.shape[0], comatrix.shape[0]))
+    for ii in range(comatrix.shape[0]):
+        for jj in range(ii, comatrix.shape[0]):
+            similarities[ii, jj] = similarities[jj, ii] = 1 - cosine(comatrix[ii, :], comatrix[jj, :])
+    return similarities
+
+def reference_naive_update(matrix, vocabulary, parsed, window_size=3):
+    peak = 65535 if matrix.dtype == np.uint16 else np.inf
+    for ii, token in enumerate(parsed):
+        if token.lemma_ not in vocabulary: continue
+        index = vocabulary[token.lemma_][2]
+        for word in parsed[max(0, ii-window_size):min(len(parsed), ii+window_size+1)]:
+            if word.lemma_ not in vocabulary: continue
+            if matrix[index, vocabulary[word.lemma_][2]] < peak: matrix[index, vocabulary[word.lemma_][2]] += 1
+    return matrix
+
+def reference_syntactic_update(matrix, vocabulary, parsed, update_method, symmetrical=False):
+    peak = 65535 if matrix.dtype == np.uint16 else np.inf
+    contexts = {vocabulary[w.lemma_][2]: [] for w in parsed if w.lemma_ in vocabulary}
+    for token in parsed:
+        if token.lemma_ not in vocabulary: continue
+        index = vocabulary[token.lemma_][2]
+        wordindexes = update_method(vocabulary, token)
+        contexts[index].extend(wordindexes)
+        if symmetrical:
+            for wordindex in wordindexes: contexts[wordindex].append(index)
+    for index, context in contexts.items():
+        for wordindex in set(context):
+            if matrix[index, wordindex] < peak: matrix[index, wordindex] += 1
+    return matrix
+
+class TokenDoc(list):
+    # the tokens of a CachedDoc without its columns, so that sentence_arrays walks the Token objects as for a spaCy Doc
+    def __init__(self, doc):
+        super().__init__(doc)
+        self.doc = doc
+
+    @property
+    def noun_chunks(self):
+        return self.doc.noun_chunks
+
+@pytest.fixture(scope='module')
+def corpus():
+    docs, vocabulary = benchmark_tools.synthetic_corpus(n_sentences=200, vocabulary_size=40, sentence_length=10, seed=3)
+    for key in ['w5', 'w11']: del vocabulary[key] # out-of-vocabulary lemmas
+    for index, key in enumerate(vocabulary): vocabulary[key][2] = index
+    return docs, vocabulary
+
+def counts(seed=0, size=25):
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 20, (size, size)) * (rng.random((size, size)) < 0.4) + np.eye(size, dtype=np.int64)
+
+@pytest.mark.parametrize('as_sparse', [False, True])
+def test_blocked_similarities_match_scipy_cosine(as_sparse):
+    comatrix = counts()
+    expected = reference_similarities(comatrix.astype(np.float64))
+    source = sparse.csr_matrix(comatrix) if as_sparse else comatrix
+    assert np.allclose(matrix_tools.construct_similarities(source, block_size=7), expected)
+    assert np.allclose(matrix_tools.construct_similarities(source, rows=[3, 0, 24]), expected[[3, 0, 24]])
+    assert np.allclose(matrix_tools.CosineSimilarities(source, dtype=np.float64)[[3, 0], :], expected[[3, 0]])
+
+@pytest.mark.parametrize('as_sparse', [False, True])
+def test_stream_similarities_match_scipy_cosine(as_sparse, tmp_path):
+    comatrix = counts()
+    expected = reference_similarities(comatrix.astype(np.float64))
+    source = sparse.csr_matrix(comatrix) if as_sparse else comatrix
+    assert np.allclose(matrix_tools.stream_similarities(source, topk=25, memory_budget=1).rows(np.arange(25)), expected, atol=1e-6)
+    path = str(tmp_path / 'similarities.npy')
+    assert np.allclose(matrix_tools.stream_similarities(source, path=path, memory_budget=1, processes=2), expected, atol=1e-6)
+    topk = matrix_tools.stream_similarities(source, path=str(tmp_path / 'topk'), topk=3)
+    loaded = matrix_tools.TopKSimilarities.load(str(tmp_path / 'topk'))
+    assert np.array_equal(loaded.indices, topk.indices) and np.array_equal(loaded.values, topk.values)
+
+@pytest.mark.parametrize('method', ['naive'] + list(matrix_tools.CONTEXT_METHODS))
+@pytest.mark.parametrize('symmetrical', [False, True])
+@pytest.mark.parametrize('buffered', [False, True])
+def test_updates_match_per_cell_saturation(corpus, method, symmetrical, buffered):
+    docs, vocabulary = corpus
+    size = len(vocabulary)
+    expected = np.full((size, size), 65530, dtype=np.uint16)
+    computed = expected.copy()
+    matrix = matrix_tools.PairBuffer(computed, capacity=500) if buffered else computed
+    for parsed in docs:
+        if method == 'naive':
+            reference_naive_update(expected, vocabulary, parsed)
+            matrix_tools.naive_update(matrix, vocabulary, parsed)
+        else:
+            update_method = matrix_tools.CONTEXT_METHODS[method]
+            reference_syntactic_update(expected, vocabulary, parsed, update_method, symmetrical)
+            matrix_tools.syntactic_update(matrix, vocabulary, parsed, update_method, symmetrical)
+    if buffered: matrix.flush()
+    assert (expected == 65535).any()
+    assert np.array_equal(computed, expected)
+
+def test_sparse_counts_match_dense_counts(corpus):
+    docs, vocabulary = corpus
+    expected = np.zeros((len(vocabulary), len(vocabulary)), dtype=np.int64)
+    accumulator = matrix_tools.SparseCounts(len(vocabulary), merge_every=100)
+    for parsed in docs:
+        reference_syntactic_update(expected, vocabulary, parsed, matrix_tools.deptree_headchildren, True)
+        matrix_tools.syntactic_update(accumulator, vocabulary, parsed, matrix_tools.deptree_headchildren, True)
+    assert np.array_equal(accumulator.tocsr().toarray(), expected)
+    with pytest.raises(ValueError): matrix_tools.SparseCounts(3, dtype=np.uint16)
+
+@pytest.mark.parametrize('as_tokens', [False, True])
+def test_array_contexts_match_token_contexts(corpus, as_tokens):
+    docs, vocabulary = corpus
+    for parsed in docs:
+        arrays = matrix_tools.sentence_arrays(TokenDoc(parsed) if as_tokens else parsed, vocabulary, noun_chunks=True)
+        contexts = matrix_tools.dependency_contexts(*arrays)
+        for name, method in matrix_tools.CONTEXT_METHODS.items():
+            assert contexts[name] == [method(vocabulary, token) for token in parsed], name
+
+def test_benchmark_contexts_agree(corpus):
+    docs, vocabulary = corpus
+    assert set(benchmark_tools.benchmark_contexts(docs[:20], vocabulary, repeat=1)) == set(matrix_tools.CONTEXT_METHODS)
+
+def test_deep_tree_ancestry():
+    length = 5000 # a chain much deeper than the recursion limit
+    heads, deps = [0] + list(range(length - 1)), ['ROOT'] + ['amod'] * (length - 1)
+    contexts = matrix_tools.dependency_contexts(heads, deps, list(range(length)), methods=['deptree_naive'])['deptree_naive']
+    assert contexts[-1] == list(range(length - 2, -1, -1))
+
+def test_similarity_cache_eviction_and_stats():
+    source = matrix_tools.CosineSimilarities(counts(size=10), dtype=np.float64)
+    expected = source.rows(np.arange(10))
+    row_bytes = expected[0].nbytes
+    cache = matrix_tools.SimilarityCache(source, max_bytes=3 * row_bytes)
+    assert np.allclose(cache[[0, 1, 2], :], expected[[0, 1, 2]]) # 3 misses
+    assert np.allclose(cache[0, :], expected[0]) # a hit, 0 becomes the most recently used
+    cache[3, :] # a miss, evicting 1
+    assert list(cache._entries) == [2, 0, 3]
+    assert np.allclose(cache[[1, 1, 1], :], expected[[1, 1, 1]]) # a miss and two hits on the repeats, evicting 2
+    assert list(cache._entries) == [0, 3, 1]
+    assert cache.stats() == {'hits': 3, 'misses': 5, 'hit_rate': 3 / 8., 'entries': 3, 'nbytes': 3 * row_bytes}
+    values = cache[[0, 5, 5, 7], [4, 6, 6, 5]] # a hit from row 0, a miss and a hit on its repeat, a miss
+    assert np.allclose(values, expected[[0, 5, 5, 7], [4, 6, 6, 5]])
+    assert list(cache._entries) == [(5, 6), (7, 5)] # the two pairs (PAIR_BYTES each) evicted rows 0, 3 and 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (5, 7) and stats['nbytes'] <= cache.max_bytes
+    small = matrix_tools.SimilarityCache(source, max_bytes=row_bytes - 1)
+    assert np.allclose(small[4, :], expected[4]) and small.stats()['entries'] == 0 # rows larger than the budget are not kept
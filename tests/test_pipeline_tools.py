@@ -0,0 +1,49 @@
+import os
+import json
+import shutil
+import numpy as np
+import pytest
+import benchmark_tools
+import pipeline_tools
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    docs, vocabulary = benchmark_tools.synthetic_corpus(n_sentences=240, vocabulary_size=30, seed=4)
+    files = benchmark_tools.write_corpus(str(tmp_path_factory.mktemp('corpus')), docs, sentences_per_file=30)
+    return files, vocabulary
+
+@pytest.mark.parametrize('sparse_counts', [False, True])
+def test_resumed_build_matches_build_matrix(corpus, tmp_path, sparse_counts):
+    files, vocabulary = corpus
+    nlp, checkpoints = benchmark_tools.SyntheticNLP(), str(tmp_path / 'checkpoints')
+    expected = pipeline_tools.build_matrix(files, vocabulary, nlp, 'deptree_headchildren', sparse_counts=sparse_counts)
+    options = {'method': 'deptree_headchildren', 'checkpoint_every': 2, 'sparse_counts': sparse_counts}
+    pipeline_tools.incremental_build(files[:3], vocabulary, nlp, checkpoints, **options)
+    os.makedirs(os.path.join(checkpoints, 'checkpoint-000099')) # left by a crash before the LATEST swap, ignored
+    resumed = pipeline_tools.incremental_build(files, vocabulary, nlp, checkpoints, **options)
+    if sparse_counts: resumed, expected = resumed.toarray(), expected.toarray()
+    assert np.array_equal(resumed, expected)
+    assert sorted(os.listdir(checkpoints)) == ['LATEST', 'checkpoint-000102'] # 2 + 3 checkpoints, the older ones removed
+    with open(os.path.join(checkpoints, 'LATEST')) as f: assert f.read() == 'checkpoint-000102'
+    with open(os.path.join(checkpoints, 'checkpoint-000102', 'manifest.json')) as f: assert sorted(json.load(f)['files'].values()) == files
+    again = pipeline_tools.incremental_build(files, vocabulary, nlp, checkpoints, **options) # every file hashed: nothing counted
+    if sparse_counts: again = again.toarray()
+    assert np.array_equal(again, expected) and os.listdir(checkpoints).count('checkpoint-000102') == 1
+
+def test_duplicate_files_are_counted_once(corpus, tmp_path):
+    files, vocabulary = corpus
+    nlp = benchmark_tools.SyntheticNLP()
+    copy = str(tmp_path / 'copy.txt')
+    shutil.copy(files[0], copy)
+    built = pipeline_tools.incremental_build(files[:2] + [copy], vocabulary, nlp, str(tmp_path / 'checkpoints'))
+    assert np.array_equal(built, pipeline_tools.build_matrix(files[:2], vocabulary, nlp))
+
+def test_resume_rejects_other_vocabulary_or_options(corpus, tmp_path):
+    files, vocabulary = corpus
+    nlp, checkpoints = benchmark_tools.SyntheticNLP(), str(tmp_path / 'checkpoints')
+    pipeline_tools.incremental_build(files[:2], vocabulary, nlp, checkpoints)
+    with pytest.raises(ValueError, match='options'): pipeline_tools.incremental_build(files, vocabulary, nlp, checkpoints, window_size=2)
+    with pytest.raises(ValueError, match='options'): pipeline_tools.incremental_build(files, vocabulary, nlp, checkpoints, method='deptree_naive')
+    other = type(vocabulary)((key, value.copy()) for key, value in vocabulary.items())
+    del other[next(iter(other))]
+    with pytest.raises(ValueError, match='vocabulary'): pipeline_tools.incremental_build(files, other, nlp, checkpoints)
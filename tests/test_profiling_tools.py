@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import benchmark_tools
+import matrix_tools
+import pipeline_tools
+from profiling_tools import PROFILER
+
+@pytest.fixture
+def profiler():
+    PROFILER.enable()
+    yield PROFILER
+    PROFILER.disable()
+    PROFILER.reset()
+
+def test_worker_stages_and_counters_are_merged(profiler, tmp_path):
+    docs, vocabulary = benchmark_tools.synthetic_corpus(n_sentences=300, vocabulary_size=30, seed=2)
+    files = benchmark_tools.write_corpus(str(tmp_path), docs, sentences_per_file=50)
+    reports = []
+    for processes in (1, 2):
+        profiler.enable()
+        pipeline_tools.build_matrix(files, vocabulary, benchmark_tools.SyntheticNLP(), 'deptree_naive', processes=processes)
+        reports.append(profiler.report())
+    assert reports[0]['counters'] == reports[1]['counters']
+    assert reports[1]['counters']['sentences'] == len(docs)
+    assert {'parsing', 'context extraction', 'matrix increments'} <= set(reports[1]['stages'])
+
+def test_accumulate_counts_saturation_as_direct_counting(profiler):
+    rng = np.random.default_rng(0)
+    # about 25000, 75000 and 25000 increments per cell: the second partial saturates by itself, the others only in the sum
+    pairs = [(rng.integers(4, size=size), rng.integers(4, size=size)) for size in (400000, 1200000, 400000)]
+    direct = matrix_tools.PairBuffer(np.zeros((4, 4), dtype=np.uint16))
+    for rows, cols in pairs: direct.add(rows, cols)
+    direct.flush()
+    expected = dict(profiler.counters)
+    profiler.reset()
+    total = np.zeros((4, 4), dtype=np.uint16)
+    for rows, cols in pairs:
+        partial = matrix_tools.PairBuffer(np.zeros((4, 4), dtype=np.uint16))
+        partial.add(rows, cols)
+        total = pipeline_tools._accumulate(total, partial.flush())
+    assert np.array_equal(total, direct.matrix)
+    assert expected['saturated_cells'] == 16
+    assert profiler.counters['saturated_cells'] == expected['saturated_cells']
+    assert profiler.counters['saturated_increments'] == expected['saturated_increments']
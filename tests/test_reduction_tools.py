@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from scipy import sparse
+import matrix_tools
+import reduction_tools
+
+def random_counts(dtype, seed=0):
+    counts = sparse.random(40, 40, density=0.2, random_state=seed, format='csr')
+    counts.data = np.floor(counts.data * 50).astype(dtype) # some entries become explicit zeros
+    return counts
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int64])
+def test_ppmi_leaves_counts_unchanged(dtype):
+    counts = random_counts(dtype)
+    data, indices, indptr = counts.data.copy(), counts.indices.copy(), counts.indptr.copy()
+    reduction_tools.ppmi(counts)
+    assert np.array_equal(counts.data, data) and np.array_equal(counts.indices, indices) and np.array_equal(counts.indptr, indptr)
+
+def test_embed_leaves_sparse_counts_unchanged():
+    rng = np.random.default_rng(0)
+    accumulator = matrix_tools.SparseCounts(40)
+    accumulator.add(rng.integers(40, size=2000), rng.integers(40, size=2000))
+    expected = accumulator.tocsr().toarray()
+    reduction_tools.embed(accumulator.tocsr(), dimension=5)
+    assert np.array_equal(accumulator.tocsr().toarray(), expected)
+
+def test_ppmi_matches_dense_formula():
+    counts = random_counts(np.float64).toarray()
+    total = counts.sum()
+    context = counts.sum(axis=0) ** 0.75
+    with np.errstate(divide='ignore'):
+        expected = np.log(counts / total) - np.log(counts.sum(axis=1, keepdims=True) / total) - np.log(context / context.sum())
+    expected = np.where(counts > 0, np.maximum(expected, 0), 0)
+    assert np.allclose(reduction_tools.ppmi(sparse.csr_matrix(counts), dtype=np.float64).toarray(), expected)
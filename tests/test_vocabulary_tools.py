@@ -0,0 +1,34 @@
+import contextlib
+import benchmark_tools
+import vocabulary_tools
+
+class LegacyNLP:
+    # a model of a spaCy version before select_pipes, recording the components it disables
+    pipe_names = ['tagger', 'parser']
+
+    def __init__(self):
+        self.disabled = []
+        self.pipe = benchmark_tools.SyntheticNLP().pipe
+
+    def disable_pipes(self, *names):
+        self.disabled.append(names)
+        return contextlib.nullcontext()
+
+class CurrentNLP(LegacyNLP):
+    # a spaCy v3 model, where disable_pipes is deprecated
+    def select_pipes(self, disable=()):
+        self.disabled.append(tuple(disable))
+        return contextlib.nullcontext()
+
+    def disable_pipes(self, *names):
+        raise AssertionError('disable_pipes is deprecated')
+
+def test_vocabularize_disables_pipes_with_select_pipes(tmp_path):
+    docs, _ = benchmark_tools.synthetic_corpus(n_sentences=20, vocabulary_size=10)
+    files = benchmark_tools.write_corpus(str(tmp_path), docs, sentences_per_file=10)
+    vocabularies = []
+    for nlp in (CurrentNLP(), LegacyNLP()):
+        vocabulary = vocabulary_tools.vocabularize(files, nlp, progress=False)
+        vocabularies.append({key: row.tolist() for key, row in vocabulary.items()})
+        assert nlp.disabled == [('parser',)] * len(files)
+    assert vocabularies[0] == vocabularies[1]
@@ -1,46 +1,197 @@
 import pickle
 import collections
+import collections.abc
+import multiprocessing
 import tqdm
 import numpy as np
+from explorer_tools import read_sentences
+from parse_tools import ParseCache
+from profiling_tools import PROFILER
 
-def vocabularize(listfile, nlp, pos_decorated=True, lemmatized=True, return_history=False):
+_worker = {} # per-process state: the spaCy model (or parse cache) and the key options
+
+def vocabularize(listfile, nlp, pos_decorated=True, lemmatized=True, return_history=False, batch_size=1000,
+                 processes=1, disable=('parser', 'ner'), progress=True, cache_dir=None):
     # vocabularize: iterate over some sample texts to produce the vocabulary and the word frequence statistics
     # Inputs:
     # - listfile: file containing the directory paths to the sample files
-    # - nlp: the spacy module to process the samples
+    # - nlp: the spacy module to process the samples, or the name of a spacy model to be loaded by every worker
     # Outputs:
-    # - vocabulary: a dictionary mapping tokens to a [1x2] numpy containing [token frequency, token-document frequency] 
+    # - vocabulary: a dictionary mapping tokens to a [1x3] numpy containing [token frequency, token-document frequency, ID] 
     # - history: a list of the vocabulary size at each iteration
     # Options:
     # - pos_decorated: whether to attach part of speech tags to the vocabulary tokens
     # - lemmatized: whether to convert words to their lemmas
     # - return_history: whether to keep a vocabulary size history 
+    # - batch_size: number of sentences fed to nlp.pipe at once
+    # - processes: number of worker processes; the per-file counts are merged in file order, so the result does not depend on it
+    # - disable: pipeline components not needed for lemmata and POS tags
+    # - progress: whether to show a progress bar
+    # - cache_dir: if given, read the parses from a parse_tools.ParseCache in this directory (parsing and storing missing files with the full pipeline)
     vocabulary = collections.OrderedDict()
     if return_history: history = []
-    for ii,filepath in tqdm.tqdm_notebook(enumerate(listfile)):
-        with open(filepath[0:-1]) as file:
-            sample = file.read()
-            local_vocabulary = []
-            for line in sample.splitlines():
-                for sentence in line.split('.'):
-                    if len(sentence.split()) < 4: continue 
-                    parsed = nlp(sentence)
-                    for token in parsed:
-                        if lemmatized: lemma = token.lemma_
-                        else: lemma=token
-                        if pos_decorated:
-                            if token.pos_ == 'PROPN': pos = 'NOUN'
-                            else: pos = token.pos_
-                            key = lemma + ' | ' + pos
-                        else: key = lemma
-                        if key not in local_vocabulary: local_vocabulary.append(key)
-                        if key not in vocabulary.keys(): vocabulary[key] = np.array([1,0,0],dtype='int') # TF / TDF / ID
-                        else: vocabulary[key][0] += 1 # term frequency
-            for key in local_vocabulary: vocabulary[key][1] += 1 # document frequency 
+    options = {'pos_decorated': pos_decorated, 'lemmatized': lemmatized, 'batch_size': batch_size, 'disable': disable,
+               'cache_dir': cache_dir}
+    if processes == 1:
+        _init_worker(nlp, options)
+        counts = ((_count_file(filepath), None) for filepath in listfile)
+        pool = None
+    else:
+        pool = multiprocessing.get_context('fork').Pool(processes, initializer=_init_process, initargs=(nlp, options))
+        counts = pool.imap(_count_file_process, listfile, chunksize=4)
+    try:
+        for local_vocabulary, recorded in tqdm.tqdm(counts, disable=not progress):
+            PROFILER.merge(recorded)
+            with PROFILER.stage('vocabulary merge'):
+                for key, frequency in local_vocabulary.items():
+                    if key not in vocabulary: vocabulary[key] = np.array([frequency,1,0],dtype='int') # TF / TDF / ID
+                    else:
+                        vocabulary[key][0] += frequency # term frequency
+                        vocabulary[key][1] += 1 # document frequency
             if return_history: history.append(len(vocabulary)) # for statistics
+    finally:
+        if pool is not None: pool.terminate()
     if return_history: return vocabulary, history
     return vocabulary
 
+def _init_worker(nlp, options):
+    if options['cache_dir'] is not None: _worker['cache'] = ParseCache(options['cache_dir'], nlp, options['batch_size'])
+    elif isinstance(nlp, str):
+        import spacy
+        nlp = spacy.load(nlp)
+    _worker['nlp'] = nlp
+    _worker['options'] = options
+
+def _init_process(nlp, options):
+    # the initializer of a worker process: drop the stages and counters inherited from the parent
+    PROFILER.reset()
+    _init_worker(nlp, options)
+
+def _count_file_process(filepath):
+    # _count_file in a worker process: the counts are sent back with the stages and counters recorded while computing them
+    local_vocabulary = _count_file(filepath)
+    return local_vocabulary, PROFILER.collect()
+
+def _count_file(filepath):
+    # count the term frequencies of a single sample file, keys in order of first appearance
+    nlp, options = _worker['nlp'], _worker['options']
+    local_vocabulary = collections.Counter()
+    if options['cache_dir'] is not None:
+        for parsed in PROFILER.timed('parsing', _worker['cache'].docs(filepath)):
+            _count_tokens(local_vocabulary, parsed, options)
+        return local_vocabulary
+    with disabled_pipes(nlp, [name for name in options['disable'] if name in nlp.pipe_names]):
+        for parsed in PROFILER.timed('parsing', nlp.pipe(read_sentences(filepath), batch_size=options['batch_size'])):
+            _count_tokens(local_vocabulary, parsed, options)
+    return local_vocabulary
+
+def disabled_pipes(nlp, names):
+    # disabled_pipes: a context manager disabling the named pipeline components, with select_pipes (spaCy v3, where disable_pipes
+    # is deprecated and warns on every call) or disable_pipes on older versions
+    if hasattr(nlp, 'select_pipes'): return nlp.select_pipes(disable=names)
+    return nlp.disable_pipes(*names)
+
+def _count_tokens(local_vocabulary, parsed, options):
+    PROFILER.count('sentences')
+    PROFILER.count('tokens', len(parsed))
+    for token in parsed: local_vocabulary[token_key(token, options['pos_decorated'], options['lemmatized'])] += 1
+
+def token_key(token, pos_decorated=True, lemmatized=True):
+    # token_key: the vocabulary key of a parsed token, e.g. 'house | NOUN' (proper nouns are merged with nouns)
+    if lemmatized: lemma = token.lemma_
+    else: lemma = token.text
+    if not pos_decorated: return lemma
+    if token.pos_ == 'PROPN': pos = 'NOUN'
+    else: pos = token.pos_
+    return lemma + ' | ' + pos
+
+class Vocabulary(collections.abc.MutableMapping):
+    # Vocabulary: a compact vocabulary backed by parallel arrays (keys and an (n, 3) array of [TF, TDF, ID] rows) with a hash index from keys to rows
+    # and a lazily built secondary index from lemmata to rows. It behaves as the OrderedDict produced by vocabularize: vocabulary[key] is a view
+    # of the key's [TF, TDF, ID] row (so vocabulary[key][0] += 1 updates it in place), and keys(), items(), membership and deletion work as for a dict.
+    # Use Vocabulary.from_dict(vocabularize(...)) to convert; the cut_*, indexize and find_by_lemma functions use vectorized paths on it.
+    def __init__(self, keys=(), counts=None):
+        self._keys = list(keys)
+        if counts is None: counts = np.zeros((len(self._keys), 3), dtype='int')
+        self._counts = np.array(counts, dtype='int').reshape(len(self._keys), 3)
+        self._size = len(self._keys)
+        self._index = {key: row for row, key in enumerate(self._keys)}
+        self._lemmata = None
+
+    @classmethod
+    def from_dict(cls, vocabulary):
+        # from_dict: build a Vocabulary from a mapping of keys to [TF, TDF, ID] arrays, keeping its order
+        return cls(list(vocabulary.keys()), [vocabulary[key] for key in vocabulary.keys()])
+
+    def to_dict(self):
+        # to_dict: the equivalent OrderedDict of [TF, TDF, ID] arrays (copies)
+        return collections.OrderedDict((key, row.copy()) for key, row in zip(self._keys, self.counts))
+
+    @property
+    def counts(self):
+        # the (n, 3) array of [TF, TDF, ID] rows, in key order
+        return self._counts[:self._size]
+
+    def __getitem__(self, key):
+        return self._counts[self._index[key]]
+
+    def __setitem__(self, key, value):
+        if key in self._index:
+            self._counts[self._index[key]] = value
+            return
+        if self._size == len(self._counts): # grow geometrically so that appending stays amortized O(1)
+            self._counts = np.concatenate([self._counts, np.zeros((max(self._size, 16), 3), dtype=self._counts.dtype)])
+        self._counts[self._size] = value
+        self._index[key] = self._size
+        self._keys.append(key)
+        self._size += 1
+        self._lemmata = None
+
+    def __delitem__(self, key):
+        mask = np.ones(self._size, dtype=bool)
+        mask[self._index[key]] = False
+        self.select(mask)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return 'Vocabulary(%d keys)' % self._size
+
+    def select(self, mask):
+        # select: keep only the rows where the boolean mask is True, in place and in order
+        rows = np.flatnonzero(mask)
+        self._keys = [self._keys[row] for row in rows]
+        self._counts = self.counts[rows]
+        self._size = len(rows)
+        self._index = {key: row for row, key in enumerate(self._keys)}
+        self._lemmata = None
+        return self
+
+    def rows(self, keys):
+        # rows: the row of every key, -1 for keys that are not in the vocabulary
+        return np.array([self._index.get(key, -1) for key in keys], dtype=np.int64)
+
+    def ids(self, keys, default=-1):
+        # ids: the ID of every key, default for keys that are not in the vocabulary
+        rows = self.rows(keys)
+        ids = np.full(len(rows), default, dtype=np.int64)
+        ids[rows >= 0] = self.counts[rows[rows >= 0], 2]
+        return ids
+
+    def lemma_rows(self, lemma):
+        # lemma_rows: the rows of all keys with the given lemma, through the lemma -> rows index
+        if self._lemmata is None:
+            self._lemmata = collections.defaultdict(list)
+            for row, key in enumerate(self._keys): self._lemmata[key.split(' | ')[0]].append(row)
+        return self._lemmata.get(lemma, [])
+
 def mutualize(vocab_lem, vocab_keys, lemma_threshold=25, key_threshold=10, position=0, verbose=True, delete=True):
     # mutualize: remove low occurence keys and lemmata from both dictionaries, to allow a 1:N correspondence between the two
     # Inputs:
@@ -65,6 +216,11 @@ def mutualize(vocab_lem, vocab_keys, lemma_threshold=25, key_threshold=10, posit
     return [x for x in set(low_occurence_lemmata + low_occ_keys_lemmatized)]
 
 def find_by_lemma(vocabulary, lemma, return_key=False):
+    if isinstance(vocabulary, Vocabulary):
+        for row in vocabulary.lemma_rows(lemma):
+            if return_key: yield vocabulary._keys[row]
+            else: yield vocabulary.counts[row, 2]
+        return
     for key in vocabulary.keys():
         if key.split(' | ')[0] == lemma:
             if return_key: yield key
@@ -87,11 +243,16 @@ def cut_stopwords(vocabulary, stopwords, verbose=True):
     length_0 = float(len(vocabulary))
     if verbose: print('Cutting stoplist')
     if verbose: print('Initial size: ', len(vocabulary))
-    for key in tqdm.tqdm_notebook(vocabulary):
-        lemma = key.split(' | ')[0]
-        if lemma in stopwords:
-            for_deletion.append(key)
-    for key in for_deletion: del vocabulary[key]
+    if isinstance(vocabulary, Vocabulary):
+        mask = np.ones(len(vocabulary), dtype=bool)
+        for lemma in set(stopwords): mask[vocabulary.lemma_rows(lemma)] = False
+        vocabulary.select(mask)
+    else:
+        for key in tqdm.tqdm(vocabulary, disable=not verbose):
+            lemma = key.split(' | ')[0]
+            if lemma in stopwords:
+                for_deletion.append(key)
+        for key in for_deletion: del vocabulary[key]
     if verbose: print('Final size: ', len(vocabulary))
     if verbose: print('Compression(%): ', (length_0 - len(vocabulary))/length_0*100)
     return vocabulary
@@ -102,11 +263,17 @@ def cut_frequency(vocabulary, threshold, position=0, delete=True, verbose=True):
     reduction = 0
     if verbose: print('Initial size: ', len(vocabulary))
     for_deletion = []
-    for key in vocabulary.keys():
-        if vocabulary[key][position] < threshold: for_deletion.append(key)
-    for key in for_deletion: 
-        reduction +=1
-        if delete: del vocabulary[key]
+    if isinstance(vocabulary, Vocabulary):
+        mask = vocabulary.counts[:, position] < threshold
+        for_deletion = [key for key, deleted in zip(vocabulary, mask) if deleted]
+        reduction = len(for_deletion)
+        if delete: vocabulary.select(~mask)
+    else:
+        for key in vocabulary.keys():
+            if vocabulary[key][position] < threshold: for_deletion.append(key)
+        for key in for_deletion: 
+            reduction +=1
+            if delete: del vocabulary[key]
     if verbose: 
         print('Final size: ', length_0-reduction)
         print('Compression(#): ', reduction)
@@ -121,6 +288,20 @@ def cut_top_edge(vocabulary, threshold=0.35, position=0, no_delete=False, verbos
     reduction = 0
     if verbose: print('Initial size: ', len(vocabulary))
     if threshold > 1: threshold = 1./threshold
+    if isinstance(vocabulary, Vocabulary) and len(vocabulary):
+        values = vocabulary.counts[:, position]
+        if verbose: print('Most common word:', next(iter(vocabulary)), 'with', values[0], 'occurrences')
+        below = np.flatnonzero(values[1:] < threshold * values[0])
+        stop = below[0] + 1 if len(below) else len(values) # the first token that is kept
+        for_deletion = [key for key, _ in zip(vocabulary, range(stop))]
+        if verbose and len(below): print('Last token deleted:', for_deletion[-1], 'with', values[stop-1], 'occurences')
+        if not no_delete: vocabulary.select(np.arange(len(values)) >= stop)
+        reduction = len(for_deletion)
+        if verbose:
+            print('Final size: ', length_0-reduction)
+            print('Compression(#): ', reduction)
+            print('Compression(%): ', (reduction/length_0))
+        return vocabulary, for_deletion
     for ii, key in enumerate(vocabulary):
         if ii==0: 
             for_deletion.append(key)
@@ -143,6 +324,11 @@ def cut_top_edge(vocabulary, threshold=0.35, position=0, no_delete=False, verbos
 def indexize(vocabulary, index=0):
     # this function adds an index value to the vocabulary to allow for int-> key mapping
     # first sort by occurrence to improve performance
+    if isinstance(vocabulary, Vocabulary):
+        order = np.argsort(-vocabulary.counts[:, index], kind='stable')
+        vocabulary.counts[order, 2] = np.arange(len(order)) # as with the OrderedDict, the IDs of the input are updated too
+        keys = list(vocabulary)
+        return Vocabulary([keys[row] for row in order], vocabulary.counts[order])
     vocabulary = collections.OrderedDict(sorted(vocabulary.items(), key=lambda x: x[1][index], reverse=True))
     for ii, key in enumerate(vocabulary):
         temp = vocabulary[key]